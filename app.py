@@ -1,94 +1,974 @@
 # === Imports ===
+import time                       # For timing operations
+IMPORT_STARTED_AT = time.perf_counter()  # Start of the import-time profile
 import os                         # For environment variables and file handling
 import glob                       # For file pattern matching (e.g., *.jpg)
 import base64                     # To encode image data into base64
 import json                       # To work with JSON data structures
 import logging                    # For logging runtime events and debugging
 import io                         # For in-memory binary operations
-import time                       # For timing operations
 import uuid                       # For generating unique filenames
+import secrets                    # Per-browser document history tokens
 import re                         # For filename sanitization
 import threading                  # For background job processing
+import tempfile                   # Spooled files for uploads being received
+import hashlib                    # For content-addressed result caching
+import gzip                       # Compressed document history on disk
+import sqlite3                    # For the shared multi-process job store
+import contextvars                # Carries trace IDs into worker threads
+import asyncio                   # For the shared async model-call loop
+import heapq                     # Expiry index for stored jobs
+import inspect                   # To handle both async stream styles of google-genai
+import random                    # For retry backoff jitter
+import html                      # To escape text in the rendered reading view
+import importlib                 # Deferred imports of heavy modules
+import importlib.util            # To check optional modules without importing them
+from html.parser import HTMLParser  # To wrap words in server-rendered HTML
+import multiprocessing           # Spawn context for the standardization process pool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future  # Worker pools for jobs and image work
+from concurrent.futures.process import BrokenProcessPool  # Raised once a pool worker has died
+from collections import OrderedDict, namedtuple  # LRU ordering for in-process caches
 from datetime import datetime, timedelta  # For job cleanup
 from pathlib import Path          # For secure path handling
-from flask import Flask, render_template, request, jsonify  # Flask web framework
-from google import genai         # Google's Gemini (GenAI) client
-from google.genai import types   # Needed to construct content parts and config
+from flask import Flask, Request, render_template, request, jsonify, Response, stream_with_context, g, has_request_context  # Flask web framework
+from werkzeug.exceptions import RequestEntityTooLarge  # 413 raised while a request body is being parsed
+from werkzeug.middleware.proxy_fix import ProxyFix  # Real client IPs behind a load balancer
 from dotenv import load_dotenv   # Load environment variables from .env file
-from PIL import Image, ImageFilter  # Pillow for image processing
-import pillow_heif               # HEIC/HEIF image format support
+
+# === Startup Profiling and Lazy Imports ===
+# Seconds spent in each startup stage, in the order they happened. Deferred
+# imports and the Gemini client add their own entries when first used.
+STARTUP_TIMINGS = OrderedDict()
+STARTUP_TIMINGS["base imports"] = time.perf_counter() - IMPORT_STARTED_AT
+
+class LazyModule:
+    """
+    Stands in for a heavy module and imports it on first attribute access.
+
+    google-genai alone takes most of a second to import, so workers only pay
+    for it when they first call Gemini. Under gunicorn --preload, set
+    EAGER_IMPORTS=true to load these once in the master instead.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    STARTUP_TIMINGS[f"import {self._name}"] = time.perf_counter() - start
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+genai = LazyModule("google.genai")                  # Google's Gemini (GenAI) client
+types = LazyModule("google.genai.types")            # Needed to construct content parts and config
+genai_errors = LazyModule("google.genai.errors")    # To tell retryable API errors apart
+Image = LazyModule("PIL.Image")                     # Pillow for image processing
+pypdf = LazyModule("pypdf")                         # Optional: split PDFs for page-parallel extraction
+markdown_it = LazyModule("markdown_it")             # Optional: server-side rendering for the reading view
+PYPDF_AVAILABLE = importlib.util.find_spec("pypdf") is not None
+MARKDOWN_IT_AVAILABLE = importlib.util.find_spec("markdown_it") is not None
+EAGER_IMPORTS = os.getenv("EAGER_IMPORTS", "false").lower() == "true"
+
+heif_support_registered = False
+heif_support_lock = threading.Lock()
+
+def ensure_heif_support():
+    """Register the HEIC/HEIF opener with Pillow the first time an image is opened"""
+    global heif_support_registered
+    if heif_support_registered:
+        return
+    with heif_support_lock:
+        if not heif_support_registered:
+            start = time.perf_counter()
+            imaging.ensure_heif_support()
+            STARTUP_TIMINGS["import pillow_heif"] = time.perf_counter() - start
+            heif_support_registered = True
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Register HEIC file format opener with Pillow
-pillow_heif.register_heif_opener()
+import imaging                    # Image standardization; reads (and checks) IMAGE_PROFILE, so imported after .env
 
 # === Logging Setup ===
-logging.basicConfig(level=logging.INFO)
+TRACE_REQUESTS = os.getenv("TRACE_REQUESTS", "false").lower() == "true"
+
+# Trace ID of the request or job being handled; "-" outside of one
+current_trace_id = contextvars.ContextVar("trace_id", default="-")
+
+class TraceIdFilter(logging.Filter):
+    """Adds the current trace ID to every log record as %(trace_id)s"""
+
+    def filter(self, record):
+        record.trace_id = current_trace_id.get()
+        return True
+
+if TRACE_REQUESTS:
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:[trace=%(trace_id)s] %(message)s")
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
+else:
+    logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)  # Allows logging with module context
 
+# === Instrumentation: Prometheus-Style Metrics ===
+# Buckets cover millisecond cache hits through multi-minute PDF extractions
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metrics:
+    """
+    A minimal in-process metrics registry rendered in the Prometheus text format.
+
+    Metrics are per process; with several gunicorn workers each worker
+    reports its own values and the scraper sums them.
+    """
+
+    def __init__(self):
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._gauges = {}      # name -> callable returning {labels: value}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def gauge(self, name, read_values):
+        """Register a gauge computed at scrape time; read_values() returns {labels tuple: value}"""
+        self._gauges[name] = read_values
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(series) for key, series in self._histograms.items()}
+
+        def header(name, metric_type):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        for name in sorted({name for name, _ in counters}):
+            header(name, "counter")
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            header(name, "histogram")
+            for (series_name, labels), series in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                for index, bound in enumerate(LATENCY_BUCKETS):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {series[index]}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {series[-2]}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {series[-1]}")
+
+        for name, read_values in sorted(self._gauges.items()):
+            header(name, "gauge")
+            for labels, value in sorted(read_values().items()):
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("stage_duration_seconds", "Time spent in each processing stage")
+metrics.describe("http_request_duration_seconds", "HTTP request latency by endpoint")
+metrics.describe("http_requests_total", "HTTP requests by endpoint and status code")
+metrics.describe("jobs_total", "Extraction jobs by outcome")
+metrics.describe("cache_lookups_total", "Cache lookups by cache and result")
+metrics.describe("bytes_total", "Bytes received from clients and exchanged with the model")
+metrics.describe("model_calls_total", "Model call attempts by model and outcome (success, retried, hedged, failed)")
+metrics.describe("coalesced_requests_total", "Requests that joined an identical in-flight computation")
+metrics.describe("uploads_rejected_total", "Uploads refused by pre-validation, by reason")
+metrics.describe("document_store_reads_total", "Document history reads by result (read, not_modified, missing)")
+metrics.describe("rate_limited_requests_total", "Requests refused by the per-client rate limiter, by budget")
+metrics.describe("model_tokens_total", "Model tokens by model and direction (input, output)")
+metrics.describe("job_queue_waiting", "Jobs waiting for a worker")
+metrics.describe("job_queue_active", "Jobs currently running")
+
+def record_timing(stage, seconds, **labels):
+    """Record a processing stage duration; the [TIMING] log lines stay as they were"""
+    metrics.observe("stage_duration_seconds", seconds, stage=stage, **labels)
+
 # === Flask App Setup ===
 app = Flask(__name__)
 UPLOAD_FOLDER = "uploads"  # Folder to temporarily store uploaded files
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)  # Ensure the folder exists
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER  # Flask config for file uploads
 
+# === Request Tracing and HTTP Metrics ===
+@app.before_request
+def start_request_trace():
+    g.request_start = time.time()
+    # Reuse the caller's ID so one trace can span the proxy, browser and app
+    trace_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    g.trace_id = trace_id
+    g.trace_token = current_trace_id.set(trace_id)
+
+@app.after_request
+def finish_request_trace(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if endpoint != "/metrics":
+        duration = time.time() - g.get("request_start", time.time())
+        metrics.observe("http_request_duration_seconds", duration, endpoint=endpoint, method=request.method)
+        metrics.inc("http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    if TRACE_REQUESTS and "trace_id" in g:
+        response.headers["X-Request-ID"] = g.trace_id
+    return response
+
+@app.teardown_request
+def clear_request_trace(exc):
+    token = g.pop("trace_token", None)
+    if token is not None:
+        try:
+            current_trace_id.reset(token)
+        except ValueError:
+            # Streamed responses finish in a different context; nothing to undo
+            pass
+
+# === Rate Limiting and Quota Accounting ===
+# Token buckets per client and budget: extraction and definitions are limited
+# separately, so a reader looking up words is never blocked by their own
+# uploads. Clients are identified by API key when they send a known one in
+# X-API-Key, otherwise by IP address.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", os.path.join("cache", "ratelimits.sqlite3"))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+# Proxies in front of the app that append to X-Forwarded-For (1 on Render)
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+# budget -> (tokens per second, bucket size)
+RATE_LIMIT_BUDGETS = {
+    "extraction": (
+        float(os.getenv("RATE_LIMIT_EXTRACTION_PER_MINUTE", "10")) / 60,
+        float(os.getenv("RATE_LIMIT_EXTRACTION_BURST", "20"))
+    ),
+    "definition": (
+        float(os.getenv("RATE_LIMIT_DEFINITION_PER_MINUTE", "120")) / 60,
+        float(os.getenv("RATE_LIMIT_DEFINITION_BURST", "60"))
+    ),
+}
+# Routes that call Gemini and the budget each one draws from
+RATE_LIMITED_ROUTES = {
+    "/upload": "extraction",
+    "/get-definition": "definition",
+    "/get-definitions": "definition",
+}
+# e.g. "classroom-app=3f9c...,kiosk=81ab..."; only listed keys are trusted
+RATE_LIMIT_API_KEYS = {
+    key.strip(): name.strip()
+    for name, _, key in (
+        item.partition("=") for item in os.getenv("RATE_LIMIT_API_KEYS", "").split(",") if "=" in item
+    )
+}
+
+if RATE_LIMIT_TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=RATE_LIMIT_TRUSTED_PROXIES)
+
+# Client the current request or job is working for; carried into job and model threads
+current_client_id = contextvars.ContextVar("client_id", default=None)
+
+RateLimitDecision = namedtuple("RateLimitDecision", "allowed limit remaining reset_seconds retry_after rate")
+
+def refill_tokens(tokens, updated_at, now, rate, burst):
+    return min(burst, tokens + max(0.0, now - updated_at) * rate)
+
+def take_tokens(tokens, cost, rate):
+    """Spend cost tokens if there are enough; returns (allowed, tokens left, seconds until affordable)"""
+    if tokens >= cost:
+        return True, tokens - cost, 0.0
+    return False, tokens, (cost - tokens) / rate
+
+USAGE_FIELDS = ("requests", "bytes_in", "bytes_out", "model_input_tokens", "model_output_tokens")
+
+class InMemoryRateLimiter:
+    """Default rate limiter: buckets and usage counters private to one process"""
+
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()  # (client_id, budget) -> (tokens, updated_at), least recently used first
+        self.usage_counters = OrderedDict()  # client_id -> {field: total}
+        self.lock = threading.Lock()
+
+    def take(self, client_id, budget, cost, rate, burst):
+        now = time.time()
+        with self.lock:
+            tokens, updated_at = self.buckets.pop((client_id, budget), (burst, now))
+            allowed, tokens, retry_after = take_tokens(refill_tokens(tokens, updated_at, now, rate, burst), cost, rate)
+            self.buckets[(client_id, budget)] = (tokens, now)
+            # Forgetting an idle client only hands it a full bucket
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return allowed, tokens, retry_after
+
+    def add_usage(self, client_id, **amounts):
+        with self.lock:
+            counters = self.usage_counters.pop(client_id, None) or dict.fromkeys(USAGE_FIELDS, 0)
+            for field, amount in amounts.items():
+                counters[field] += amount
+            self.usage_counters[client_id] = counters
+            while len(self.usage_counters) > self.max_clients:
+                self.usage_counters.popitem(last=False)
+
+    def usage(self, client_id):
+        with self.lock:
+            return dict(self.usage_counters.get(client_id) or dict.fromkeys(USAGE_FIELDS, 0))
+
+class SqliteConnections:
+    """
+    Per-thread connections to one SQLite file in WAL mode, for the stores
+    that share state between gunicorn workers. A connection is only used by
+    the thread and process that opened it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()  # sqlite3 connections are per thread
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.get().execute("PRAGMA journal_mode=WAL")
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        # A connection opened before a fork (gunicorn --preload) must not be reused
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+class SqliteRateLimiter:
+    """Rate limiter in a SQLite file, so every gunicorn worker draws from the same buckets"""
+
+    def __init__(self, path):
+        self.connections = SqliteConnections(path)
+        conn = self.connections.get()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "client_id TEXT NOT NULL, budget TEXT NOT NULL, tokens REAL NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (client_id, budget))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage (client_id TEXT PRIMARY KEY, "
+            + ", ".join(f"{field} INTEGER NOT NULL DEFAULT 0" for field in USAGE_FIELDS)
+            + ", updated_at REAL NOT NULL)"
+        )
+
+    def take(self, client_id, budget, cost, rate, burst):
+        now = time.time()
+        conn = self.connections.get()
+        # BEGIN IMMEDIATE takes the write lock up front so read-modify-write is atomic
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE client_id = ? AND budget = ?", (client_id, budget)
+            ).fetchone()
+            tokens, updated_at = row if row else (burst, now)
+            allowed, tokens, retry_after = take_tokens(refill_tokens(tokens, updated_at, now, rate, burst), cost, rate)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (client_id, budget, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                (client_id, budget, tokens, now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, tokens, retry_after
+
+    def add_usage(self, client_id, **amounts):
+        fields = [field for field in USAGE_FIELDS if field in amounts]
+        self.connections.get().execute(
+            f"INSERT INTO usage (client_id, {', '.join(fields)}, updated_at) "
+            f"VALUES (?, {', '.join('?' for _ in fields)}, ?) "
+            f"ON CONFLICT (client_id) DO UPDATE SET "
+            + ", ".join(f"{field} = {field} + excluded.{field}" for field in fields)
+            + ", updated_at = excluded.updated_at",
+            [client_id] + [amounts[field] for field in fields] + [time.time()]
+        )
+
+    def usage(self, client_id):
+        row = self.connections.get().execute(
+            f"SELECT {', '.join(USAGE_FIELDS)} FROM usage WHERE client_id = ?", (client_id,)
+        ).fetchone()
+        return dict(zip(USAGE_FIELDS, row or (0,) * len(USAGE_FIELDS)))
+
+def create_rate_limiter():
+    if RATE_LIMIT_BACKEND == "sqlite":
+        return SqliteRateLimiter(RATE_LIMIT_PATH)
+    if RATE_LIMIT_BACKEND != "memory":
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {RATE_LIMIT_BACKEND}")
+    return InMemoryRateLimiter(RATE_LIMIT_MAX_CLIENTS)
+
+rate_limiter = create_rate_limiter()
+
+def rate_limit_client_id(api_key, remote_addr):
+    """Stable client ID: the name of a known API key, otherwise the IP address"""
+    if api_key and api_key in RATE_LIMIT_API_KEYS:
+        return f"key:{RATE_LIMIT_API_KEYS[api_key]}"
+    return f"ip:{remote_addr or 'unknown'}"
+
+def check_rate_limit(client_id, budget, cost=1):
+    """Spend cost tokens from a client's budget; cost is capped at the bucket size so it can always succeed eventually"""
+    rate, burst = RATE_LIMIT_BUDGETS[budget]
+    cost = min(cost, burst)
+    allowed, tokens, retry_after = rate_limiter.take(client_id, budget, cost, rate, burst)
+    if not allowed:
+        metrics.inc("rate_limited_requests_total", budget=budget)
+    return RateLimitDecision(
+        allowed=allowed,
+        limit=int(burst),
+        remaining=int(tokens),
+        reset_seconds=(burst - tokens) / rate,
+        retry_after=retry_after,
+        rate=rate
+    )
+
+def rate_limit_headers(decision):
+    """IETF RateLimit header fields, plus Retry-After when the request was refused"""
+    headers = {
+        "RateLimit-Limit": str(decision.limit),
+        "RateLimit-Remaining": str(decision.remaining),
+        "RateLimit-Reset": str(max(0, int(decision.reset_seconds + 0.999))),
+        "RateLimit-Policy": f"{decision.limit};w={int(decision.limit / decision.rate)}",
+    }
+    if not decision.allowed:
+        headers["Retry-After"] = str(max(1, int(decision.retry_after + 0.999)))
+    return headers
+
+def record_usage(client_id, **amounts):
+    """Add to a client's usage counters; a failed write is logged, never raised"""
+    try:
+        rate_limiter.add_usage(client_id, **amounts)
+    except Exception as e:
+        logger.warning(f"Could not record usage for {client_id}: {e}")
+
+async def record_model_usage(model, usage_metadata):
+    """Count a Gemini call's tokens in /metrics and against the client that caused it"""
+    if usage_metadata is None:
+        return
+    input_tokens = getattr(usage_metadata, "prompt_token_count", None) or 0
+    output_tokens = getattr(usage_metadata, "candidates_token_count", None) or 0
+    metrics.inc("model_tokens_total", input_tokens, model=model, direction="input")
+    metrics.inc("model_tokens_total", output_tokens, model=model, direction="output")
+    client_id = current_client_id.get()
+    if client_id:
+        # With the SQLite limiter this is a blocking write; on the shared
+        # model loop it would stall every other call in flight
+        await asyncio.to_thread(
+            record_usage, client_id, model_input_tokens=input_tokens, model_output_tokens=output_tokens
+        )
+
+def definition_batch_cost(data):
+    """
+    Batched model calls a /get-definitions body can cause, charged up front.
+    Single-call fallbacks for items a batch did not answer are charged when
+    they happen (see charge_definition_fallback).
+    """
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return 1
+    return max(1, -(-len(items) // DEFINITION_BATCH_SIZE))
+
+@app.before_request
+def enforce_rate_limit():
+    client_id = rate_limit_client_id(request.headers.get("X-API-Key"), request.remote_addr)
+    g.client_id = client_id
+    g.client_token = current_client_id.set(client_id)
+
+    budget = RATE_LIMITED_ROUTES.get(request.url_rule.rule if request.url_rule else None)
+    if not RATE_LIMIT_ENABLED or budget is None or request.method != "POST":
+        return None
+
+    if request.url_rule.rule == "/upload":
+        cost = max(1, len(request.files.getlist("file")))  # One token per file
+    elif request.url_rule.rule == "/get-definitions":
+        cost = definition_batch_cost(request.get_json(silent=True))
+    else:
+        cost = 1
+    g.rate_limit = check_rate_limit(client_id, budget, cost)
+    if not g.rate_limit.allowed:
+        logger.warning(f"Rate limited {client_id} on {request.url_rule.rule} ({budget})")
+        return jsonify({"error": "Too many requests. Please wait a moment and try again."}), 429
+    return None
+
+@app.after_request
+def add_rate_limit_headers(response):
+    decision = g.get("rate_limit")
+    if decision is None:
+        return response
+    response.headers.update(rate_limit_headers(decision))
+    record_usage(
+        g.client_id,
+        requests=1,
+        bytes_in=request.content_length or 0,
+        bytes_out=response.calculate_content_length() or 0
+    )
+    return response
+
+@app.teardown_request
+def clear_request_client(exc):
+    token = g.pop("client_token", None)
+    if token is not None:
+        try:
+            current_client_id.reset(token)
+        except ValueError:
+            # Streamed responses finish in a different context; nothing to undo
+            pass
+
 # === Job Storage for Async Processing ===
-job_storage = {}
-job_lock = threading.Lock()
+class InMemoryJobStore:
+    """
+    Default job store: a dict guarded by a lock, private to one process.
+
+    Jobs are indexed by creation time in a heap, so expiring old jobs only
+    touches the expired ones. Completed results count against a byte budget;
+    past it, the oldest results are moved to disk (when spill_dir is set) or
+    their jobs are dropped early.
+
+    Args:
+        max_result_bytes: Budget for results held in memory (0 = unlimited).
+        spill_dir: Directory for results moved out of memory, or None.
+        spill_threshold_bytes: Results at least this large go straight to disk
+            when spill_dir is set (0 = only spill when over budget).
+    """
+
+    def __init__(self, max_result_bytes=0, spill_dir=None, spill_threshold_bytes=0):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.max_result_bytes = max_result_bytes
+        self.spill_dir = spill_dir
+        self.spill_threshold_bytes = spill_threshold_bytes
+        self.result_bytes = 0
+        self._expiry_heap = []              # (created_at timestamp, job_id), oldest first
+        self._result_sizes = OrderedDict()  # job_id -> bytes of its in-memory result, oldest first
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def create(self, job_id, job):
+        with self.lock:
+            self.jobs[job_id] = job
+            heapq.heappush(self._expiry_heap, (job["created_at"].timestamp(), job_id))
+
+    def update(self, job_id, fields):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            if fields.get("result") is not None:
+                self._track_result(job_id, job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            job = dict(job) if job else None
+        if job and job.get("result_path"):
+            # Result was moved to disk; load it back for this caller only
+            try:
+                with open(job["result_path"], "r", encoding="utf-8") as f:
+                    job["result"] = json.load(f)
+            except (OSError, ValueError) as e:
+                # Callers expect a completed job to carry its result
+                logger.warning(f"Could not read spilled result for job {job_id}: {e}")
+                job.update(status="failed", result=None, error="Result expired. Please upload the file again.")
+        return job
+
+    def delete_older_than(self, cutoff):
+        cutoff_timestamp = cutoff.timestamp()
+        with self.lock:
+            while self._expiry_heap and self._expiry_heap[0][0] < cutoff_timestamp:
+                _, job_id = heapq.heappop(self._expiry_heap)
+                self._remove(job_id)
+
+    def _track_result(self, job_id, job):
+        """Account for a new result, then enforce the spill threshold and byte budget"""
+        self._forget_result_size(job_id)
+        size = len(json.dumps(job["result"]))
+        if self.spill_dir and self.spill_threshold_bytes and size >= self.spill_threshold_bytes:
+            self._spill(job_id, job)
+            return
+        self._result_sizes[job_id] = size
+        self.result_bytes += size
+
+        while self.max_result_bytes and self.result_bytes > self.max_result_bytes and self._result_sizes:
+            oldest_id = next(iter(self._result_sizes))
+            if self.spill_dir:
+                self._forget_result_size(oldest_id)
+                self._spill(oldest_id, self.jobs[oldest_id])
+            else:
+                # No disk to move to: expire the oldest result's job early
+                logger.info(f"Job store over {self.max_result_bytes} bytes, dropping job {oldest_id}")
+                self._remove(oldest_id)
+
+    def _spill(self, job_id, job):
+        path = os.path.join(self.spill_dir, f"{job_id}.json")
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(job["result"], f)
+        except OSError as e:
+            logger.warning(f"Could not spill result for job {job_id}, dropping job: {e}")
+            self._remove(job_id)
+            return
+        job["result"] = None
+        job["result_path"] = path
+
+    def _forget_result_size(self, job_id):
+        size = self._result_sizes.pop(job_id, None)
+        if size is not None:
+            self.result_bytes -= size
+
+    def _remove(self, job_id):
+        job = self.jobs.pop(job_id, None)
+        self._forget_result_size(job_id)
+        if job and job.get("result_path"):
+            try:
+                os.remove(job["result_path"])
+            except OSError:
+                pass
+
+class SqliteJobStore:
+    """
+    Job store shared by every process that opens the same SQLite file.
+
+    WAL mode lets status polls read while a worker is writing, so any
+    gunicorn worker can answer /status for a job started by another.
+    """
+
+    def __init__(self, path):
+        self.connections = SqliteConnections(path)
+        conn = self.connections.get()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, created_at REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)")
+
+    def create(self, job_id, job):
+        data = {key: value for key, value in job.items() if key != "created_at"}
+        self.connections.get().execute(
+            "INSERT INTO jobs (job_id, created_at, data) VALUES (?, ?, ?)",
+            (job_id, job["created_at"].timestamp(), json.dumps(data))
+        )
+
+    def update(self, job_id, fields):
+        conn = self.connections.get()
+        # BEGIN IMMEDIATE takes the write lock up front so read-modify-write is atomic
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row:
+                data = json.loads(row[0])
+                data.update(fields)
+                conn.execute("UPDATE jobs SET data = ? WHERE job_id = ?", (json.dumps(data), job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, job_id):
+        row = self.connections.get().execute(
+            "SELECT created_at, data FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if not row:
+            return None
+        job = json.loads(row[1])
+        job["created_at"] = datetime.fromtimestamp(row[0])
+        return job
+
+    def delete_older_than(self, cutoff):
+        self.connections.get().execute("DELETE FROM jobs WHERE created_at < ?", (cutoff.timestamp(),))
+
+def create_job_store():
+    """Build the job store selected by JOB_STORE ("memory" or "sqlite")"""
+    backend = os.getenv("JOB_STORE", "memory").lower()
+    if backend == "sqlite":
+        path = os.getenv("JOB_STORE_PATH", os.path.join("cache", "jobs.sqlite3"))
+        logger.info(f"Using SQLite job store at {path}")
+        return SqliteJobStore(path)
+    if backend != "memory":
+        raise ValueError(f"Unknown JOB_STORE backend: {backend}")
+    return InMemoryJobStore(
+        max_result_bytes=int(os.getenv("JOB_RESULTS_MAX_BYTES", str(100 * 1024 * 1024))),  # 100MB
+        spill_dir=os.getenv("JOB_RESULT_SPILL_DIR") or None,
+        spill_threshold_bytes=int(os.getenv("JOB_RESULT_SPILL_THRESHOLD_BYTES", str(256 * 1024)))
+    )
+
+job_store = create_job_store()
+
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+JOB_REAPER_INTERVAL_SECONDS = int(os.getenv("JOB_REAPER_INTERVAL_SECONDS", "30"))
+job_reaper_pid = None  # Process that owns the running reaper thread
+job_reaper_lock = threading.Lock()
+
+def run_job_reaper():
+    while True:
+        time.sleep(JOB_REAPER_INTERVAL_SECONDS)
+        try:
+            cleanup_old_jobs()
+        except Exception as e:
+            logger.error(f"Job reaper failed: {e}")
+
+def ensure_job_reaper():
+    """Start the background job reaper once per process (threads do not survive fork)"""
+    global job_reaper_pid
+    if job_reaper_pid == os.getpid():
+        return
+    with job_reaper_lock:
+        if job_reaper_pid != os.getpid():
+            threading.Thread(target=run_job_reaper, name="job-reaper", daemon=True).start()
+            job_reaper_pid = os.getpid()
 
 def create_job():
     """Create a new job and return its ID"""
+    ensure_job_reaper()
     job_id = str(uuid.uuid4())
-    with job_lock:
-        job_storage[job_id] = {
-            "status": "processing",
-            "created_at": datetime.now(),
-            "result": None,
-            "error": None
-        }
+    job_store.create(job_id, {
+        "status": "processing",
+        "created_at": datetime.now(),
+        "result": None,
+        "error": None,
+        "trace_id": current_trace_id.get()
+    })
     return job_id
 
-def update_job(job_id, status=None, result=None, error=None):
+# Wakes /stream/<job_id> listeners in this process when a job changes;
+# listeners also re-check on a timeout to see updates made by other workers.
+job_update_condition = threading.Condition()
+
+def update_job(job_id, status=None, result=None, error=None, **extra_fields):
     """Update job status"""
-    with job_lock:
-        if job_id in job_storage:
-            if status:
-                job_storage[job_id]["status"] = status
-            if result is not None:
-                job_storage[job_id]["result"] = result
-            if error is not None:
-                job_storage[job_id]["error"] = error
+    fields = dict(extra_fields)
+    if status:
+        fields["status"] = status
+    if result is not None:
+        fields["result"] = result
+    if error is not None:
+        fields["error"] = error
+    if fields:
+        job_store.update(job_id, fields)
+        with job_update_condition:
+            job_update_condition.notify_all()
 
 def get_job(job_id):
     """Get job status"""
-    with job_lock:
-        return job_storage.get(job_id)
+    return job_store.get(job_id)
 
 def cleanup_old_jobs():
-    """Remove jobs older than 1 hour"""
-    with job_lock:
-        cutoff = datetime.now() - timedelta(hours=1)
-        to_remove = [
-            job_id for job_id, job in job_storage.items()
-            if job["created_at"] < cutoff
-        ]
-        for job_id in to_remove:
-            del job_storage[job_id]
+    """Remove jobs older than JOB_TTL_SECONDS (1 hour by default)"""
+    job_store.delete_older_than(datetime.now() - timedelta(seconds=JOB_TTL_SECONDS))
+
+# === Bounded Job Queues with Admission Control ===
+QUEUE_RETRY_AFTER_SECONDS = int(os.getenv("QUEUE_RETRY_AFTER_SECONDS", "15"))
+
+class QueueFullError(Exception):
+    """Raised when a job queue is at its depth limit and cannot accept more work"""
+
+class JobQueue:
+    """
+    A fixed-size worker pool with a bounded waiting list.
+
+    Jobs beyond `max_workers` wait in submission order; once `max_pending`
+    jobs are waiting, new submissions are rejected so bursts degrade into
+    fast 503 responses instead of unbounded threads and memory.
+    """
+
+    def __init__(self, name, max_workers, max_pending):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-worker")
+        self._waiting = []  # Job IDs waiting for a worker, oldest first
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def submit(self, job_id, fn):
+        """Queue fn() to run for job_id, or raise QueueFullError"""
+        with self._lock:
+            if len(self._waiting) >= self.max_pending:
+                raise QueueFullError(f"{self.name} queue is full ({self.max_pending} waiting)")
+            self._waiting.append(job_id)
+
+        # Run in a copy of the caller's context so the request's trace ID
+        # follows the job onto the worker thread
+        context = contextvars.copy_context()
+
+        def run():
+            with self._lock:
+                self._waiting.remove(job_id)
+                self._active += 1
+            try:
+                fn()
+            finally:
+                with self._lock:
+                    self._active -= 1
+
+        self._executor.submit(context.run, run)
+
+    def position(self, job_id):
+        """Return the 1-based position of a waiting job, or None if it is not waiting"""
+        with self._lock:
+            try:
+                return self._waiting.index(job_id) + 1
+            except ValueError:
+                return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "waiting": len(self._waiting),
+                "active": self._active,
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending
+            }
+
+# PDFs are slower and larger than photos, so they get their own pool and limits
+# and cannot starve image uploads.
+job_queues = {
+    "image": JobQueue(
+        "image",
+        max_workers=int(os.getenv("IMAGE_WORKERS", "2")),
+        max_pending=int(os.getenv("IMAGE_QUEUE_MAX", "20"))
+    ),
+    "pdf": JobQueue(
+        "pdf",
+        max_workers=int(os.getenv("PDF_WORKERS", "1")),
+        max_pending=int(os.getenv("PDF_QUEUE_MAX", "5"))
+    ),
+}
+
+def read_queue_gauge(field):
+    return lambda: {
+        (("queue", name),): job_queue.stats()[field]
+        for name, job_queue in job_queues.items()
+    }
+
+if isinstance(job_store, InMemoryJobStore):
+    metrics.describe("job_store_result_bytes", "Bytes of job results held in memory")
+    metrics.gauge("job_store_result_bytes", lambda: {(): job_store.result_bytes})
+    metrics.describe("job_store_jobs", "Job records held in memory")
+    metrics.gauge("job_store_jobs", lambda: {(): len(job_store.jobs)})
+
+metrics.gauge("job_queue_waiting", read_queue_gauge("waiting"))
+metrics.gauge("job_queue_active", read_queue_gauge("active"))
+
+def get_queue_position(job_id):
+    """Return the queue position of a job across all queues, or None"""
+    for job_queue in job_queues.values():
+        position = job_queue.position(job_id)
+        if position is not None:
+            return position
+    return None
+
+# === Request Coalescing (Single-Flight) ===
+class SingleFlight:
+    """
+    Lets concurrent callers with the same key share one computation.
+
+    The first caller for a key becomes the leader and runs the work; callers
+    arriving while it is in flight wait on the leader's Future instead of
+    starting their own. Coalescing is per process.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}  # key -> Future
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """Return (future, is_leader); a leader must call finish() for the key"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                metrics.inc("coalesced_requests_total", kind=self.name)
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def do(self, key, fn):
+        """Run fn() once for all concurrent callers with this key"""
+        future, is_leader = self.begin(key)
+        if not is_leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result=result)
+        return result
+
+# Identical uploads in flight: result-cache key -> (job ID of the running job,
+# document owners of every upload attached to it, in arrival order)
+inflight_extractions = {}
+inflight_extractions_lock = threading.Lock()
 
 # === Google Gemini Client Initialization ===
 def initialize_genai_client():
+    # GENAI_BACKEND=fake swaps in a local stub for load tests and benchmarks;
+    # it needs no credentials and never calls Vertex AI.
+    if os.getenv("GENAI_BACKEND", "vertex").lower() == "fake":
+        from fake_genai import FakeClient
+        logger.warning("Using fake Gemini backend (GENAI_BACKEND=fake)")
+        return FakeClient()
+
     # Load service account credentials from environment variable
     service_account_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
     if not service_account_json:
         raise ValueError("GOOGLE_SERVICE_ACCOUNT_JSON environment variable not set")
 
     try:
-        # Write credentials to a temp file for authentication
-        with open("temp_service_account.json", "w") as f:
-            f.write(service_account_json)
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "temp_service_account.json"
+        # Build credentials in memory instead of writing them to a temp file
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials.from_service_account_info(
+            json.loads(service_account_json),
+            scopes=["https://www.googleapis.com/auth/cloud-platform"]
+        )
     except Exception as e:
         logger.error(f"Error handling service account: {e}")
         raise
@@ -96,82 +976,361 @@ def initialize_genai_client():
     # Return a Gemini client authenticated with Vertex AI
     return genai.Client(
         vertexai=True,
+        credentials=credentials,
         project=os.getenv("GOOGLE_PROJECT", "engaging-reader"),
         location=os.getenv("GOOGLE_LOCATION", "us-central1"),
     )
 
-# Create the client once and reuse it globally
-client = initialize_genai_client()
+# Created on first use, once per process: a client made before a fork
+# (gunicorn --preload) would share its connection pool with every worker
+genai_client = None
+genai_client_lock = threading.Lock()
+
+def get_genai_client():
+    global genai_client
+    if genai_client is None:
+        with genai_client_lock:
+            if genai_client is None:
+                start = time.perf_counter()
+                genai_client = initialize_genai_client()
+                STARTUP_TIMINGS["genai client"] = time.perf_counter() - start
+    return genai_client
+
+# === Async Model Calls: Shared Event Loop with Per-Model Concurrency Limits ===
+# Every Gemini call runs on one background event loop through client.aio, so
+# all requests share one connection pool, in-flight calls per model are capped
+# by a semaphore, and each call has a timeout and can be cancelled.
+DEFAULT_MODEL_CONCURRENCY = int(os.getenv("DEFAULT_MODEL_CONCURRENCY", "16"))
+# e.g. "gemini-2.5-flash=8,gemini-2.5-flash-lite=32"
+MODEL_CONCURRENCY_LIMITS = {
+    name.strip(): int(limit)
+    for name, _, limit in (
+        item.partition("=") for item in os.getenv("MODEL_CONCURRENCY_LIMITS", "").split(",") if "=" in item
+    )
+}
 
-# === Helper Function: Get Latest File ===
-def get_latest_file(directory="uploads", extensions=("jpg", "jpeg", "png", "heic", "heif", "webp", "pdf")):
-    # Find all supported files with matching extensions
-    files = [f for ext in extensions for f in glob.glob(os.path.join(directory, f"*.{ext}"))]
-    return max(files, key=os.path.getmtime) if files else None  # Return latest one or None
+class ModelCallTimeout(Exception):
+    """Raised when a model call does not finish within its timeout"""
+
+# === Call Policy: Retries with Backoff, Hedged Requests and Fallback Models ===
+# HTTP status codes worth retrying: throttling, timeouts and server errors
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
 
-# === Helper Function: Standardize Image ===
-def standardize_image(input_image_bytes: bytes, options: dict = None) -> bytes:
+class CallPolicy:
     """
-    Standardizes an image by resizing, sharpening, and compressing to JPEG.
-    Ideal for processing user-uploaded photos to ensure consistency and performance.
+    How one kind of model call behaves when Gemini is slow or failing.
 
     Args:
-        input_image_bytes: The raw bytes of the input image (HEIC, JPEG, etc.).
-        options: A dictionary for optional settings.
-            - max_dimension (int): The maximum width or height. Defaults to 2048.
-            - quality (int): The output JPEG quality (1-95). Defaults to 85.
+        model: Primary model name.
+        timeout: Seconds allowed per attempt, including time waiting for a slot.
+        fallback_model: Model tried once after the primary's attempts are used up.
+        max_attempts: Attempts on the primary model.
+        backoff_base: First retry waits up to this many seconds; doubles each retry.
+        backoff_max: Upper bound for a single retry wait.
+        hedge_after: Start a second identical call if no chunk has arrived after
+            this many seconds; the first to stream wins. 0 disables hedging.
+    """
 
-    Returns:
-        The raw bytes of the processed JPEG image.
-        
-    Raises:
-        IOError: If the image format is not supported or the data is corrupt.
+    def __init__(self, model, timeout, fallback_model=None, max_attempts=3,
+                 backoff_base=0.5, backoff_max=8.0, hedge_after=0.0):
+        self.model = model
+        self.timeout = timeout
+        self.fallback_model = fallback_model or None
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+
+    @classmethod
+    def from_env(cls, prefix, model, default_timeout, default_hedge_after):
+        """Build a policy from <PREFIX>_* environment variables"""
+        return cls(
+            model=model,
+            timeout=float(os.getenv(f"{prefix}_CALL_TIMEOUT_SECONDS", str(default_timeout))),
+            fallback_model=os.getenv(f"{prefix}_FALLBACK_MODEL"),
+            max_attempts=int(os.getenv(f"{prefix}_MAX_ATTEMPTS", "3")),
+            backoff_base=float(os.getenv(f"{prefix}_BACKOFF_BASE_SECONDS", "0.5")),
+            backoff_max=float(os.getenv(f"{prefix}_BACKOFF_MAX_SECONDS", "8")),
+            hedge_after=float(os.getenv(f"{prefix}_HEDGE_AFTER_SECONDS", str(default_hedge_after))),
+        )
+
+    def attempt_models(self):
+        """Model for each attempt, in order: the primary's retries, then the fallback"""
+        models = [self.model] * self.max_attempts
+        if self.fallback_model:
+            models.append(self.fallback_model)
+        return models
+
+    def backoff_seconds(self, retry_number):
+        """Exponential backoff with full jitter, so retries from many callers spread out"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** retry_number)))
+
+def is_retryable_error(error):
+    if isinstance(error, (ModelCallTimeout, ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, genai_errors.APIError) or hasattr(error, "code"):
+        return getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+    # Transport failures from the HTTP client google-genai uses
+    return type(error).__module__.startswith("httpx") and type(error).__name__.endswith(("Error", "Timeout"))
+
+async def run_in_context(context, coro):
+    """Await coro with the caller's context variables (trace and client IDs) set"""
+    for variable, value in context.items():
+        variable.set(value)
+    return await coro
+
+class AsyncModelCaller:
     """
-    if options is None:
-        options = {}
+    Runs Gemini calls on a dedicated event loop thread shared by the whole process.
 
-    settings = {
-        'max_dimension': options.get('max_dimension', 2048),
-        'quality': options.get('quality', 85)
-    }
+    The client and the loop thread are created on first use in each process,
+    so importing the app stays cheap and forked workers get their own loop.
+    """
 
-    try:
-        # Open the image from in-memory bytes
-        image_stream = io.BytesIO(input_image_bytes)
-        with Image.open(image_stream) as img:
-            # If image has transparency (like some PNGs or HEICs), convert it to RGB
-            # as JPEG does not support an alpha channel.
-            if img.mode in ("RGBA", "P"):
-                img = img.convert("RGB")
-
-            # Resize the image while maintaining aspect ratio
-            img.thumbnail((settings['max_dimension'], settings['max_dimension']))
-
-            # Sharpen the image to enhance text clarity
-            img = img.filter(ImageFilter.SHARPEN)
-
-            # Save the processed image to an in-memory buffer
-            output_buffer = io.BytesIO()
-            img.save(
-                output_buffer,
-                format="JPEG",
-                quality=settings['quality'],
-                optimize=True  # Makes an extra pass to find best compression
+    def __init__(self, get_client):
+        self._get_client = get_client
+        self.loop = None
+        self._loop_pid = None
+        self._loop_lock = threading.Lock()
+        self._semaphores = {}  # Created lazily, always on self.loop
+
+    @property
+    def client(self):
+        return self._get_client()
+
+    def ensure_loop(self):
+        # Threads do not survive fork, so a loop inherited from the master is dead
+        if self._loop_pid != os.getpid():
+            with self._loop_lock:
+                if self._loop_pid != os.getpid():
+                    self.loop = asyncio.new_event_loop()
+                    self._semaphores = {}
+                    threading.Thread(target=self.loop.run_forever, name="model-call-loop", daemon=True).start()
+                    self._loop_pid = os.getpid()
+        return self.loop
+
+    def _semaphore(self, model):
+        semaphore = self._semaphores.get(model)
+        if semaphore is None:
+            limit = MODEL_CONCURRENCY_LIMITS.get(model, DEFAULT_MODEL_CONCURRENCY)
+            semaphore = self._semaphores[model] = asyncio.Semaphore(limit)
+        return semaphore
+
+    async def stream_text(self, model, contents, config, timeout, on_chunk=None):
+        """
+        Stream a response and return its full text, calling on_chunk(text)
+        for each chunk. Waiting for a free slot counts toward the timeout.
+        """
+        async def consume():
+            async with self._semaphore(model):
+                stream = self.client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=config,
+                )
+                # Older google-genai versions return the iterator directly
+                if inspect.isawaitable(stream):
+                    stream = await stream
+                output_text = ""
+                usage_metadata = None
+                async for chunk in stream:
+                    if chunk.text:  # Only add text if it's not None
+                        output_text += chunk.text
+                        if on_chunk:
+                            on_chunk(chunk.text)
+                    # Token counts arrive with the last chunk
+                    usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+            await record_model_usage(model, usage_metadata)
+            return output_text
+
+        try:
+            return await asyncio.wait_for(consume(), timeout)
+        except asyncio.TimeoutError:
+            raise ModelCallTimeout(f"{model} call timed out after {timeout:.0f} seconds")
+
+    async def generate(self, model, contents, config, timeout):
+        """Make a non-streaming call and return the response"""
+        async def call():
+            async with self._semaphore(model):
+                response = await self.client.aio.models.generate_content(
+                    model=model,
+                    contents=contents,
+                    config=config,
+                )
+            await record_model_usage(model, getattr(response, "usage_metadata", None))
+            return response
+
+        try:
+            return await asyncio.wait_for(call(), timeout)
+        except asyncio.TimeoutError:
+            raise ModelCallTimeout(f"{model} call timed out after {timeout:.0f} seconds")
+
+    async def _hedged_stream(self, model, contents, config, timeout, hedge_after, on_chunk):
+        """
+        One logical attempt that may race two identical calls.
+
+        If no chunk has arrived after hedge_after seconds, a second call is
+        started. Whichever streams first wins; only its chunks are forwarded
+        and the other call is cancelled.
+        """
+        tasks = []
+        winner = None
+
+        def make_forwarder(index):
+            def forward(text):
+                nonlocal winner
+                if winner is None:
+                    winner = index
+                    for other_index, other in enumerate(tasks):
+                        if other_index != index:
+                            other.cancel()
+                if winner == index and on_chunk:
+                    on_chunk(text)
+            return forward
+
+        def start_call():
+            tasks.append(asyncio.ensure_future(
+                self.stream_text(model, contents, config, timeout, on_chunk=make_forwarder(len(tasks)))
+            ))
+
+        start_call()
+        last_error = None
+        try:
+            while True:
+                pending = {task for task in tasks if not task.done()}
+                if not pending:
+                    break
+                can_hedge = hedge_after > 0 and len(tasks) == 1 and winner is None
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=hedge_after if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Still no first chunk within the latency budget: hedge
+                    logger.info(f"[POLICY] No first chunk from {model} after {hedge_after:.1f}s, hedging")
+                    metrics.inc("model_calls_total", model=model, outcome="hedged")
+                    start_call()
+                    continue
+
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                    elif winner in (None, tasks.index(task)):
+                        return task.result()
+
+                # The winning call failed mid-stream; its partial output cannot be
+                # continued by the other call, so the attempt fails
+                if winner is not None and tasks[winner].done():
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise last_error or ModelCallTimeout(f"{model} call produced no result")
+
+    async def _run_with_policy(self, policy, make_call):
+        """
+        Run make_call(model) under a CallPolicy. Retryable errors are retried on
+        the primary model with backoff; once those attempts are used up, or on a
+        non-retryable error, the fallback model (if any) gets one attempt.
+        """
+        models = policy.attempt_models()
+        attempt = 0
+        while True:
+            model = models[attempt]
+            try:
+                result = await make_call(model)
+                metrics.inc("model_calls_total", model=model, outcome="success")
+                return result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                is_last = attempt + 1 >= len(models)
+                if not is_last and not is_retryable_error(e):
+                    if not policy.fallback_model:
+                        is_last = True
+                    else:
+                        # Retrying the same model will not help; go straight to the fallback
+                        attempt = len(models) - 2
+                if is_last:
+                    metrics.inc("model_calls_total", model=model, outcome="failed")
+                    raise
+                metrics.inc("model_calls_total", model=model, outcome="retried")
+                delay = policy.backoff_seconds(attempt)
+                logger.warning(f"[POLICY] {model} attempt {attempt + 1} failed ({e}); retrying with {models[attempt + 1]} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def stream_with_policy(self, policy, contents, config, on_chunk=None):
+        """
+        Stream a response under a CallPolicy, hedging slow first chunks.
+
+        Text already forwarded to on_chunk is not repeated when a retry
+        streams the same output again.
+        """
+        forwarded_length = 0
+
+        async def make_call(model):
+            received_length = 0
+
+            def forward_new_text(text):
+                nonlocal forwarded_length, received_length
+                received_length += len(text)
+                # Skip the part of this attempt's output an earlier attempt already sent
+                if received_length > forwarded_length:
+                    if on_chunk:
+                        on_chunk(text[len(text) - (received_length - forwarded_length):])
+                    forwarded_length = received_length
+
+            return await self._hedged_stream(
+                model, contents, config, policy.timeout, policy.hedge_after, forward_new_text
             )
-            return output_buffer.getvalue()
 
-    except Exception as e:
-        print(f"Error during image standardization: {e}")
-        # Re-raising the exception allows the calling function to handle the error
-        raise
+        return await self._run_with_policy(policy, make_call)
 
-# === Core Function: Process Uploaded File and Extract Markdown ===
-def process_file(file_path):
-    file_process_start = time.time()
-    logger.info(f"[TIMING] process_file() started for: {file_path}")
-    
-    # Create a prompt to guide Gemini on how to extract the data
-    text_prompt = types.Part.from_text(text="""Act as an expert document intelligence agent. Your mission is to analyze the document (image or PDF), process its content based on the rules below, and generate a clean, well-structured Markdown document.
+    async def generate_with_policy(self, policy, contents, config):
+        """Non-streaming call under a CallPolicy (retries and fallback, no hedging)"""
+        return await self._run_with_policy(
+            policy, lambda model: self.generate(model, contents, config, policy.timeout)
+        )
+
+    def submit(self, coro):
+        """Schedule a coroutine on the model loop and return a concurrent.futures.Future"""
+        # Tasks on the loop thread do not inherit the caller's context, so
+        # carry it over: token usage is charged to the client that asked
+        return asyncio.run_coroutine_threadsafe(
+            run_in_context(contextvars.copy_context(), coro), self.ensure_loop()
+        )
+
+    async def call_async(self, coro):
+        """Await a model coroutine from another event loop (e.g. the ASGI server's)"""
+        # Cancelling the awaiting task cancels the model call too
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def call(self, coro):
+        """Run a model coroutine from synchronous code and wait for the result"""
+        future = self.submit(coro)
+        try:
+            return future.result()
+        except BaseException:
+            # Cancel the in-flight call if this thread gives up (e.g. shutdown)
+            future.cancel()
+            raise
+
+model_caller = AsyncModelCaller(get_genai_client)
+
+# === Helper Function: Get Latest File ===
+def get_latest_file(directory="uploads", extensions=("jpg", "jpeg", "png", "heic", "heif", "webp", "pdf")):
+    # Find all supported files with matching extensions
+    files = [f for ext in extensions for f in glob.glob(os.path.join(directory, f"*.{ext}"))]
+    return max(files, key=os.path.getmtime) if files else None  # Return latest one or None
+
+# === Extraction Prompt and Model ===
+EXTRACTION_MODEL = "gemini-2.5-flash"  # Model used to extract Markdown from documents
+EXTRACTION_CALL_POLICY = CallPolicy.from_env("EXTRACTION", EXTRACTION_MODEL, default_timeout=240, default_hedge_after=20)
+EXTRACTION_PROMPT = """Act as an expert document intelligence agent. Your mission is to analyze the document (image or PDF), process its content based on the rules below, and generate a clean, well-structured Markdown document.
 
 Step 1: Language Processing Rule
 
@@ -206,65 +1365,499 @@ Footnotes:
 -- In the table cell, mark the reference number with a tilde, like this: 1,234,567~1~.
 -- Begin the footnote text itself with the same marker, like this: ~1~ This is the footnote text.
 
-Completeness: Ensure all extracted (or translated) text, including any URLs, is present in the final output.""")
+Completeness: Ensure all extracted (or translated) text, including any URLs, is present in the final output."""
 
-    # Read and process the file (image or PDF)
-    read_start = time.time()
-    with open(file_path, "rb") as file:
-        original_file_bytes = file.read()
-    read_duration = time.time() - read_start
-    logger.info(f"[TIMING] File read in {read_duration:.3f} seconds ({len(original_file_bytes)} bytes)")
-    
-    # Determine file type based on extension
-    _, file_extension = os.path.splitext(file_path.lower())
-    
-    if file_extension == '.pdf':
-        # Handle PDF files directly - no standardization needed
-        file_data = original_file_bytes
-        mime_type = "application/pdf"
-        logger.info(f"[TIMING] Processing PDF file: {len(original_file_bytes)} bytes")
-        
-    else:
-        # Handle image files with standardization
+# === Result Cache: Content-Addressed Storage of Extracted Markdown ===
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join("cache", "results"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))  # 200MB
+RESULT_CACHE_MAX_AGE_SECONDS = int(os.getenv("RESULT_CACHE_MAX_AGE_SECONDS", str(7 * 24 * 3600)))  # 7 days
+result_cache_lock = threading.Lock()
+
+def new_cache_hasher(model=EXTRACTION_MODEL, prompt=EXTRACTION_PROMPT):
+    """
+    Start a result-cache hash seeded with the model name, prompt text and
+    image profile. Changing any of them produces a new key, so stale
+    results are never served after a prompt edit or a profile switch.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(model.encode("utf-8") + b"\0")
+    hasher.update(prompt.encode("utf-8") + b"\0")
+    hasher.update(imaging.IMAGE_PROFILE.encode("utf-8") + b"\0")
+    return hasher
+
+def _result_cache_path(cache_key):
+    return os.path.join(RESULT_CACHE_DIR, f"{cache_key}.json")
+
+def get_cached_result(cache_key):
+    """
+    Return the cached result for a key as {"markdown", "reading_view"}, or
+    None on a miss or expired entry. reading_view is None for entries stored
+    before it was built.
+    """
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return None
+
+    path = _result_cache_path(cache_key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - entry.get("created_at", 0) > RESULT_CACHE_MAX_AGE_SECONDS:
         try:
-            standardize_start = time.time()
-            # Standardize the image to improve OCR accuracy and reduce processing time
-            standardized_image_bytes = standardize_image(original_file_bytes)
-            standardize_duration = time.time() - standardize_start
-            logger.info(f"[TIMING] Image standardized in {standardize_duration:.3f} seconds: {len(original_file_bytes)} -> {len(standardized_image_bytes)} bytes")
-            
-            # Use standardized image data
-            file_data = standardized_image_bytes
-            mime_type = "image/jpeg"  # Standardized images are always JPEG
-            
-        except Exception as e:
-            # Fall back to original image if standardization fails
-            logger.warning(f"Image standardization failed, using original: {e}")
-            file_data = original_file_bytes
-            
-            # Determine MIME type based on file extension for fallback
-            if file_extension in ['.png']:
-                mime_type = "image/png"
-            elif file_extension in ['.jpg', '.jpeg']:
-                mime_type = "image/jpeg"
-            elif file_extension in ['.heic', '.heif']:
-                mime_type = "image/heic"
-            elif file_extension in ['.webp']:
-                mime_type = "image/webp"
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    # Touch the entry so eviction treats it as recently used (LRU by mtime)
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    if entry.get("markdown") is None:
+        return None
+    return {"markdown": entry["markdown"], "reading_view": entry.get("reading_view")}
+
+def replace_file(path, data):
+    """Write bytes to path through a temporary file, so readers see the old or new file, never a partial one"""
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)  # Atomic, also for readers in other workers
+
+def store_cached_result(cache_key, markdown, reading_view=None):
+    """Write a result to the cache atomically, then evict down to the size limit"""
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return
+
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        replace_file(
+            _result_cache_path(cache_key),
+            json.dumps({"created_at": time.time(), "markdown": markdown, "reading_view": reading_view}).encode("utf-8")
+        )
+        evict_result_cache()
+    except OSError as e:
+        logger.warning(f"[CACHE] Failed to store result {cache_key}: {e}")
+
+def evict_result_cache():
+    """Drop expired entries, then least recently used entries until under the byte limit"""
+    with result_cache_lock:
+        entries = []
+        now = time.time()
+        for path in glob.glob(os.path.join(RESULT_CACHE_DIR, "*.json")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > RESULT_CACHE_MAX_AGE_SECONDS:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= RESULT_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+            except OSError:
+                pass
+
+# === Reading View: Precomputed Words, Blocks and Sentences ===
+# Rendering the Markdown and wrapping every word in a span is the slowest
+# part of showing a long document on a low-end phone. The reading view does
+# that work once per job on the server:
+#   html       Rendered HTML with each word already wrapped in a bare
+#              <span class=w>; the browser adds the classes and keyboard
+#              attributes, which would otherwise be most of the payload
+#   text       The words as spoken: single spaces, a newline between blocks
+#   sentence_starts
+#              Index of the first word of each sentence; a sentence is the
+#              "context sentence" sent to /get-definition
+# Word offsets and block ranges follow from the separators in `text`, so
+# the browser derives them instead of receiving them.
+READING_VIEW_ENABLED = os.getenv("READING_VIEW_ENABLED", "true").lower() == "true" and MARKDOWN_IT_AVAILABLE
+READING_VIEW_VERSION = 2
+READING_VIEW_BLOCK_TAGS = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "li", "th", "td", "pre", "blockquote"}
+WORD_SPAN_OPEN = '<span class=w>'
+SENTENCE_END_PATTERN = re.compile(r"[.!?][\"'”’)\]]*$")
+markdown_renderer = None  # Built on first use
+
+def get_markdown_renderer():
+    global markdown_renderer
+    if markdown_renderer is None:
+        markdown_renderer = markdown_it.MarkdownIt("commonmark", {"html": False}).enable(["table", "strikethrough"])
+    return markdown_renderer
+
+class WordSpanWriter(HTMLParser):
+    """Re-emit rendered HTML with each whitespace-separated word wrapped in a span"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.words = []
+        self.word_blocks = []  # Block number of each word
+        self.block_stack = []
+        self.block_count = 0
+
+    def handle_starttag(self, tag, attrs):
+        self.out.append(self.get_starttag_text())
+        if tag in READING_VIEW_BLOCK_TAGS:
+            self.block_count += 1
+            self.block_stack.append(self.block_count)
+
+    def handle_startendtag(self, tag, attrs):
+        self.out.append(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        self.out.append(f"</{tag}>")
+        if tag in READING_VIEW_BLOCK_TAGS and self.block_stack:
+            self.block_stack.pop()
+
+    def handle_data(self, data):
+        block = self.block_stack[-1] if self.block_stack else 0
+        for piece in re.split(r"(\s+)", data):
+            if not piece:
+                continue
+            if piece.isspace():
+                self.out.append(piece)
             else:
-                # Default to JPEG for unsupported formats
-                mime_type = "image/jpeg"
+                self.out.append(f"{WORD_SPAN_OPEN}{html.escape(piece, quote=False)}</span>")
+                self.words.append(piece)
+                self.word_blocks.append(block)
+
+def build_reading_view(markdown):
+    """Render Markdown into the precomputed reading view, or None when disabled"""
+    if not READING_VIEW_ENABLED:
+        return None
+
+    start_time = time.time()
+    writer = WordSpanWriter()
+    writer.feed(get_markdown_renderer().render(markdown))
+    writer.close()
+    words, word_blocks = writer.words, writer.word_blocks
+
+    text_parts = []
+    sentence_starts = []
+    for index, word in enumerate(words):
+        new_block = index == 0 or word_blocks[index] != word_blocks[index - 1]
+        if index:
+            text_parts.append("\n" if new_block else " ")
+        text_parts.append(word)
+        if new_block or SENTENCE_END_PATTERN.search(words[index - 1]):
+            sentence_starts.append(index)
+
+    record_timing("reading_view", time.time() - start_time)
+    return {
+        "version": READING_VIEW_VERSION,
+        "html": "".join(writer.out),
+        "text": "".join(text_parts),
+        "sentence_starts": sentence_starts,
+    }
 
-    file_part = types.Part.from_bytes(
-        data=file_data,
-        mime_type=mime_type,
-    )
+def safe_build_reading_view(markdown):
+    """Build the reading view, logging instead of failing the job; clients fall back to raw Markdown"""
+    try:
+        return build_reading_view(markdown)
+    except Exception as e:
+        logger.warning(f"Could not build reading view: {e}")
+        return None
+
+def wants_reading_view():
+    """Clients opt in to the reading view with ?view=reading"""
+    return request.args.get("view") == "reading"
+
+def present_result(result, include_reading_view):
+    """Copy a job result for a response, keeping the reading view only when it was asked for"""
+    result = dict(result)
+    reading_view = result.pop("reading_view", None)
+    if include_reading_view and reading_view is not None:
+        result["reading_view"] = reading_view
+    return result
+
+# === Document Store: Compressed Extraction History ===
+# Completed results outlive their jobs here: gzip-compressed on disk and
+# indexed in SQLite by content hash (the result-cache key) and by job ID, so
+# re-opening a document is one local read instead of a new extraction. Unlike
+# the result cache, entries are only evicted when the byte budget is reached.
+DOCUMENT_STORE_ENABLED = os.getenv("DOCUMENT_STORE_ENABLED", "false").lower() == "true"
+DOCUMENT_STORE_DIR = os.getenv("DOCUMENT_STORE_DIR", os.path.join("cache", "documents"))
+DOCUMENT_STORE_MAX_BYTES = int(os.getenv("DOCUMENT_STORE_MAX_BYTES", str(1024 * 1024 * 1024)))  # 1GB compressed
+DOCUMENT_STORE_COMPRESSION_LEVEL = int(os.getenv("DOCUMENT_STORE_COMPRESSION_LEVEL", "6"))
+DOCUMENT_LIST_MAX = 100  # Most documents returned by one /documents listing
+
+class DocumentStore:
+    """
+    Compressed result files plus a SQLite index, shared by every process
+    that opens the same directory.
+
+    Each distinct document is stored once under its content hash; the jobs
+    table maps every job and each owner who received it to a document, so
+    repeat uploads of the same file cost one index row per reader.
+    """
+
+    def __init__(self, directory, max_bytes, compression_level):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        self.connections = SqliteConnections(os.path.join(directory, "index.sqlite3"))  # Also creates directory
+        conn = self.connections.get()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "content_hash TEXT PRIMARY KEY, created_at REAL NOT NULL, opened_at REAL NOT NULL, "
+            "stored_bytes INTEGER NOT NULL, markdown_bytes INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS documents_opened_at ON documents (opened_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT NOT NULL, content_hash TEXT NOT NULL, owner TEXT NOT NULL, "
+            "filename TEXT, created_at REAL NOT NULL, PRIMARY KEY (job_id, owner))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_owner_created_at ON jobs (owner, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_content_hash ON jobs (content_hash)")
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.directory, f"{content_hash}.json.gz")
+
+    def _write_blob(self, content_hash, markdown, reading_view):
+        """Compress a document to its file atomically and return the compressed size"""
+        data = gzip.compress(
+            json.dumps({"markdown": markdown, "reading_view": reading_view}).encode("utf-8"),
+            compresslevel=self.compression_level
+        )
+        replace_file(self._blob_path(content_hash), data)
+        return len(data)
+
+    def put(self, content_hash, job_id, owners, filename, markdown, reading_view=None):
+        """Record a completed job for each of its owners, writing the compressed document only if it is new"""
+        now = time.time()
+        conn = self.connections.get()
+        exists = conn.execute(
+            "SELECT 1 FROM documents WHERE content_hash = ?", (content_hash,)
+        ).fetchone()
+        if not exists:
+            stored_bytes = self._write_blob(content_hash, markdown, reading_view)
+            conn.execute(
+                "INSERT OR REPLACE INTO documents "
+                "(content_hash, created_at, opened_at, stored_bytes, markdown_bytes) VALUES (?, ?, ?, ?, ?)",
+                (content_hash, now, now, stored_bytes, len(markdown.encode("utf-8")))
+            )
+        conn.executemany(
+            "INSERT OR REPLACE INTO jobs (job_id, content_hash, owner, filename, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(job_id, content_hash, owner, filename, now) for owner in owners]
+        )
+        if not exists:
+            self.evict()
+
+    def resolve(self, document_id):
+        """
+        Look up a document by content hash or by the ID of any job that
+        produced it; returns index fields only, without reading the file.
+        """
+        row = self.connections.get().execute(
+            "SELECT d.content_hash, d.created_at, d.stored_bytes, d.markdown_bytes, "
+            "(SELECT filename FROM jobs j WHERE j.content_hash = d.content_hash ORDER BY created_at DESC LIMIT 1) "
+            "FROM documents d WHERE d.content_hash = ? "
+            "UNION ALL "
+            "SELECT d.content_hash, d.created_at, d.stored_bytes, d.markdown_bytes, j.filename "
+            "FROM jobs j JOIN documents d ON d.content_hash = j.content_hash WHERE j.job_id = ? "
+            "LIMIT 1",
+            (document_id, document_id)
+        ).fetchone()
+        if not row:
+            return None
+        return dict(zip(("document_id", "created_at", "stored_bytes", "markdown_bytes", "filename"), row))
+
+    def load(self, content_hash):
+        """Return {"markdown", "reading_view"} for a stored document, or None"""
+        try:
+            with open(self._blob_path(content_hash), "rb") as f:
+                entry = json.loads(gzip.decompress(f.read()))
+        except (OSError, ValueError, EOFError):
+            return None
+        self.connections.get().execute(
+            "UPDATE documents SET opened_at = ? WHERE content_hash = ?", (time.time(), content_hash)
+        )
+        return {"markdown": entry["markdown"], "reading_view": entry.get("reading_view")}
+
+    def replace_reading_view(self, content_hash, markdown, reading_view):
+        """Rewrite a document stored before reading views were built"""
+        stored_bytes = self._write_blob(content_hash, markdown, reading_view)
+        self.connections.get().execute(
+            "UPDATE documents SET stored_bytes = ? WHERE content_hash = ?", (stored_bytes, content_hash)
+        )
+
+    def recent(self, owner, limit):
+        """An owner's documents, most recently extracted or re-uploaded first"""
+        # SQLite fills the bare columns from the row that holds MAX(created_at)
+        rows = self.connections.get().execute(
+            "SELECT j.content_hash, j.job_id, j.filename, MAX(j.created_at), d.markdown_bytes "
+            "FROM jobs j JOIN documents d ON d.content_hash = j.content_hash "
+            "WHERE j.owner = ? GROUP BY j.content_hash ORDER BY MAX(j.created_at) DESC LIMIT ?",
+            (owner, limit)
+        ).fetchall()
+        return [
+            dict(zip(("document_id", "job_id", "filename", "created_at", "markdown_bytes"), row))
+            for row in rows
+        ]
+
+    def evict(self):
+        """Drop least recently opened documents until under the byte limit"""
+        if not self.max_bytes:
+            return
+        conn = self.connections.get()
+        total_bytes = conn.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM documents").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        for content_hash, stored_bytes in conn.execute(
+            "SELECT content_hash, stored_bytes FROM documents ORDER BY opened_at"
+        ).fetchall():
+            if total_bytes <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM documents WHERE content_hash = ?", (content_hash,))
+            conn.execute("DELETE FROM jobs WHERE content_hash = ?", (content_hash,))
+            try:
+                os.remove(self._blob_path(content_hash))
+            except OSError:
+                pass
+            total_bytes -= stored_bytes
+            logger.info(f"[CACHE] Evicted stored document {content_hash}")
+
+document_store = DocumentStore(
+    DOCUMENT_STORE_DIR, DOCUMENT_STORE_MAX_BYTES, DOCUMENT_STORE_COMPRESSION_LEVEL
+) if DOCUMENT_STORE_ENABLED else None
+
+# History belongs to an API key, or else to one browser through a random
+# cookie; never to an IP address, which a whole classroom behind NAT shares
+READER_ID_COOKIE = "reader_id"
+READER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{32,64}$")
+
+def document_owner(issue=False):
+    """
+    Whose document history the current request belongs to: "key:<name>" for
+    a known API key, else "browser:<token>" from the reader_id cookie. With
+    issue=True a browser without a valid cookie gets a new token, which
+    set_reader_id_cookie() sends back; otherwise such a request has no owner.
+    """
+    api_key = request.headers.get("X-API-Key")
+    if api_key and api_key in RATE_LIMIT_API_KEYS:
+        return f"key:{RATE_LIMIT_API_KEYS[api_key]}"
+    token = request.cookies.get(READER_ID_COOKIE, "")
+    if not READER_ID_PATTERN.match(token):
+        token = g.get("new_reader_id")
+        if token is None and issue:
+            token = g.new_reader_id = secrets.token_urlsafe(32)
+    return f"browser:{token}" if token else None
+
+@app.after_request
+def set_reader_id_cookie(response):
+    token = g.get("new_reader_id")
+    if token:
+        response.set_cookie(
+            READER_ID_COOKIE, token, max_age=365 * 24 * 3600,
+            httponly=True, samesite="Lax", secure=request.is_secure
+        )
+    return response
+
+def remember_document(content_hash, job_id, owners, filename, markdown, reading_view):
+    """Add a completed job to the document history of each owner; failures only cost the history entry"""
+    if document_store is None or not content_hash:
+        return
+    try:
+        document_store.put(content_hash, job_id, owners, filename, markdown, reading_view)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"[CACHE] Failed to store document {content_hash}: {e}")
+
+def get_stored_document(content_hash):
+    """Return a stored document as {"markdown", "reading_view"}, or None when absent or disabled"""
+    if document_store is None or not content_hash:
+        return None
+    try:
+        return document_store.load(content_hash)
+    except sqlite3.Error as e:
+        logger.warning(f"[CACHE] Failed to read document {content_hash}: {e}")
+        return None
+
+def load_document_result(info):
+    """
+    Read a document found by DocumentStore.resolve() as a job result,
+    building its reading view once if it was stored before they existed.
+    """
+    stored = get_stored_document(info["document_id"])
+    if stored is None:
+        return None
+    if stored["reading_view"] is None and READING_VIEW_ENABLED:
+        stored["reading_view"] = safe_build_reading_view(stored["markdown"])
+        try:
+            document_store.replace_reading_view(info["document_id"], stored["markdown"], stored["reading_view"])
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"[CACHE] Failed to update document {info['document_id']}: {e}")
+    return {
+        "markdown": stored["markdown"],
+        "reading_view": stored["reading_view"],
+        "filename": info["filename"],
+        "document_id": info["document_id"]
+    }
+
+# === Core Function: Extract Markdown from a Document Part with Gemini ===
+MULTI_PART_INSTRUCTION = (
+    "The files below are consecutive pages of one document, in order. "
+    "Extract them as one continuous document."
+)
+
+def extract_markdown(file_data, mime_type, on_chunk=None):
+    """
+    Send one document part to Gemini and stream back the extracted Markdown.
+
+    Args:
+        file_data: Bytes of the image or PDF part to extract.
+        mime_type: MIME type of file_data.
+        on_chunk: Optional callable invoked with each text chunk as it streams in.
+
+    Returns:
+        The complete Markdown text for this part.
+    """
+    return extract_markdown_parts([(file_data, mime_type)], on_chunk=on_chunk)
+
+def extract_markdown_parts(file_parts, on_chunk=None):
+    """
+    Send one or more files to Gemini in a single request as pages of one
+    document, and stream back the extracted Markdown.
+
+    Args:
+        file_parts: List of (bytes, mime_type) in page order.
+        on_chunk: Optional callable invoked with each text chunk as it streams in.
+
+    Returns:
+        The complete Markdown text for these files.
+    """
+    # Create a prompt to guide Gemini on how to extract the data
+    prompt_parts = [types.Part.from_text(text=EXTRACTION_PROMPT)]
+    if len(file_parts) > 1:
+        prompt_parts.append(types.Part.from_text(text=MULTI_PART_INSTRUCTION))
+
+    file_parts_for_model = [
+        types.Part.from_bytes(
+            data=file_data,
+            mime_type=mime_type,
+        )
+        for file_data, mime_type in file_parts
+    ]
 
     # Package the user message as content parts for Gemini
     contents = [
         types.Content(
             role="user",
-            parts=[text_prompt, file_part]
+            parts=prompt_parts + file_parts_for_model
         )
     ]
 
@@ -279,49 +1872,525 @@ Completeness: Ensure all extracted (or translated) text, including any URLs, is
     # Stream response from Gemini and concatenate result
     gemini_start = time.time()
     logger.info(f"[TIMING] Starting Gemini API call")
-    output_text = ""
     first_chunk_received = False
-    for chunk in client.models.generate_content_stream(
-        model="gemini-2.5-flash",
-        contents=contents,
-        config=config,
-    ):
-        if chunk.text:  # Only add text if it's not None
-            if not first_chunk_received:
-                first_chunk_time = time.time() - gemini_start
-                logger.info(f"[TIMING] First chunk received in {first_chunk_time:.3f} seconds")
-                first_chunk_received = True
-            output_text += chunk.text
+
+    def handle_chunk(text):
+        nonlocal first_chunk_received
+        if not first_chunk_received:
+            first_chunk_time = time.time() - gemini_start
+            logger.info(f"[TIMING] First chunk received in {first_chunk_time:.3f} seconds")
+            record_timing("gemini_first_chunk", first_chunk_time, model=EXTRACTION_MODEL)
+            first_chunk_received = True
+        if on_chunk:
+            on_chunk(text)
+
+    output_text = model_caller.call(model_caller.stream_with_policy(
+        EXTRACTION_CALL_POLICY, contents, config,
+        on_chunk=handle_chunk
+    ))
     
     gemini_duration = time.time() - gemini_start
     logger.info(f"[TIMING] Gemini API completed in {gemini_duration:.3f} seconds")
+    record_timing("gemini_total", gemini_duration, model=EXTRACTION_MODEL)
+    metrics.inc("bytes_total", sum(len(file_data) for file_data, _ in file_parts), direction="model_request")
+    metrics.inc("bytes_total", len(output_text.encode("utf-8")), direction="model_response")
+
+    return output_text
+
+# === PDF Page Splitting for Parallel Extraction ===
+PDF_SPLIT_PAGES = os.getenv("PDF_SPLIT_PAGES", "true").lower() == "true"
+PDF_PAGES_PER_PART = max(1, int(os.getenv("PDF_PAGES_PER_PART", "2")))
+PDF_PAGE_FANOUT = max(1, int(os.getenv("PDF_PAGE_FANOUT", "4")))
+
+def split_pdf_pages(pdf_bytes, pages_per_part=PDF_PAGES_PER_PART):
+    """
+    Split a PDF into smaller PDFs of `pages_per_part` pages each.
+
+    Returns a list of PDF byte strings in page order, or None when pypdf is
+    not installed or the document is too short to be worth splitting.
+    """
+    if not PYPDF_AVAILABLE:
+        return None
+
+    reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+    page_count = len(reader.pages)
+    if page_count <= pages_per_part:
+        return None
+
+    parts = []
+    for start in range(0, page_count, pages_per_part):
+        writer = pypdf.PdfWriter()
+        for page in reader.pages[start:start + pages_per_part]:
+            writer.add_page(page)
+        part_buffer = io.BytesIO()
+        writer.write(part_buffer)
+        parts.append(part_buffer.getvalue())
+    return parts
+
+def pdf_cache_key(cache_key):
+    """Result-cache key of a single PDF: its file key plus the split settings its output depends on"""
+    hasher = new_cache_hasher()
+    hasher.update(f"{PDF_SPLIT_PAGES and PYPDF_AVAILABLE}\0{PDF_PAGES_PER_PART}\0".encode("utf-8"))
+    hasher.update(cache_key.encode("ascii"))
+    return hasher.hexdigest()
+
+def extract_parts(parts, on_chunk=None, on_progress=None, fanout=PDF_PAGE_FANOUT):
+    """
+    Extract several document parts concurrently and join them in page order.
+
+    Each part is a list of (bytes, mime_type) sent together in one Gemini
+    call, with its own output token budget, so long documents are no longer
+    cut off and wall-clock time tracks the slowest part. Text is forwarded to
+    on_chunk one whole part at a time, in order, as soon as every earlier
+    part has finished.
+    """
+    results = [None] * len(parts)
+    next_to_emit = 0
+    completed = 0
+    order_lock = threading.Lock()
+
+    def run_part(index):
+        nonlocal next_to_emit, completed
+        text = extract_markdown_parts(parts[index])
+        with order_lock:
+            results[index] = text
+            completed += 1
+            if on_progress:
+                on_progress(completed, len(parts))
+            # Release this part and any later parts that were waiting on it
+            while next_to_emit < len(parts) and results[next_to_emit] is not None:
+                if on_chunk:
+                    separator = "\n\n" if next_to_emit > 0 else ""
+                    on_chunk(separator + results[next_to_emit])
+                next_to_emit += 1
+
+    with ThreadPoolExecutor(max_workers=min(fanout, len(parts)), thread_name_prefix="document-part") as executor:
+        # Each part runs in its own copy of the job's context, so its model
+        # tokens are charged to the client and its log lines keep the trace ID
+        futures = [
+            executor.submit(contextvars.copy_context().run, run_part, index)
+            for index in range(len(parts))
+        ]
+        # result() re-raises the first part failure, which fails the job
+        for future in futures:
+            future.result()
+
+    return "\n\n".join(results)
+
+# === Core Function: Process Uploaded File and Extract Markdown ===
+def process_file(source, on_chunk=None, on_progress=None, file_extension=None):
+    """
+    Extract Markdown from an uploaded image or PDF with Gemini.
+
+    Args:
+        source: Path to the uploaded file, or its raw bytes when the upload
+            was kept in memory (file_extension is then required).
+        on_chunk: Optional callable invoked with each text chunk as it streams in.
+        on_progress: Optional callable invoked with (completed_parts, total_parts)
+            while a split PDF is being extracted.
+        file_extension: Lowercase extension such as ".jpg"; derived from the
+            path when not given.
+
+    Returns:
+        The complete Markdown text.
+    """
+    file_process_start = time.time()
+    in_memory = isinstance(source, (bytes, bytearray))
+    logger.info(f"[TIMING] process_file() started for: {'<in-memory upload>' if in_memory else source}")
+
+    # Determine file type based on extension
+    if file_extension is None:
+        _, file_extension = os.path.splitext(source.lower())
+
+    # Images on disk are decoded straight from the file; only PDFs and the
+    # image fallback path need the whole upload as bytes.
+    original_file_bytes = bytes(source) if in_memory else None
+    original_size = len(source) if in_memory else os.path.getsize(source)
+
+    def read_original_bytes():
+        nonlocal original_file_bytes
+        if original_file_bytes is None:
+            read_start = time.time()
+            with open(source, "rb") as file:
+                original_file_bytes = file.read()
+            read_duration = time.time() - read_start
+            logger.info(f"[TIMING] File read in {read_duration:.3f} seconds ({len(original_file_bytes)} bytes)")
+            record_timing("file_read", read_duration)
+        return original_file_bytes
+    
+    if file_extension == '.pdf':
+        # Handle PDF files directly - no standardization needed
+        file_data = read_original_bytes()
+        mime_type = "application/pdf"
+        logger.info(f"[TIMING] Processing PDF file: {len(file_data)} bytes")
+
+        parts = None
+        if PDF_SPLIT_PAGES:
+            try:
+                parts = split_pdf_pages(file_data)
+            except Exception as e:
+                # Fall back to sending the whole PDF if it cannot be split
+                logger.warning(f"PDF split failed, sending whole document: {e}")
+
+        if parts:
+            logger.info(f"[TIMING] PDF split into {len(parts)} parts, fan-out {PDF_PAGE_FANOUT}")
+            output_text = extract_parts(
+                [[(part, "application/pdf")] for part in parts],
+                on_chunk=on_chunk,
+                on_progress=on_progress
+            )
+            total_process_duration = time.time() - file_process_start
+            logger.info(f"[TIMING] Total process_file() duration: {total_process_duration:.3f} seconds")
+            record_timing("process_total", total_process_duration, kind="pdf_split")
+            return output_text
+        
+    else:
+        # Handle image files with standardization
+        try:
+            standardize_start = time.time()
+            # Standardize the image to improve OCR accuracy and reduce processing time
+            standardized_image_bytes = imaging.standardize_image(source)
+            standardize_duration = time.time() - standardize_start
+            logger.info(f"[TIMING] Image standardized in {standardize_duration:.3f} seconds: {original_size} -> {len(standardized_image_bytes)} bytes")
+            record_timing("standardize", standardize_duration)
+            
+            # Use standardized image data
+            file_data = standardized_image_bytes
+            mime_type = "image/jpeg"  # Standardized images are always JPEG
+            
+        except Exception as e:
+            # Fall back to original image if standardization fails
+            logger.warning(f"Image standardization failed, using original: {e}")
+            file_data = read_original_bytes()
+            
+            # Determine MIME type based on file extension for fallback
+            mime_type = imaging.mime_type_for_extension(file_extension)
+
+    output_text = extract_markdown(file_data, mime_type, on_chunk=on_chunk)
     
     total_process_duration = time.time() - file_process_start
     logger.info(f"[TIMING] Total process_file() duration: {total_process_duration:.3f} seconds")
+    record_timing("process_total", total_process_duration, kind="pdf" if file_extension == ".pdf" else "image")
 
     return output_text  # Return the markdown-formatted output
 
+# === Multi-File Documents: Parallel Standardization ===
+# A letter photographed page by page arrives as several files in one upload.
+# Pillow work is CPU-bound, so the pages are standardized in a process pool
+# (threads would take turns on the GIL) before going to Gemini. Each worker
+# costs tens of MB, so only a couple are started unless STANDARDIZE_PROCESSES
+# says otherwise.
+def available_cpus():
+    """CPUs this process may run on; os.cpu_count() is the whole host's count"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS
+        return os.cpu_count() or 1
+
+MAX_UPLOAD_FILES = int(os.getenv("MAX_UPLOAD_FILES", "20"))
+STANDARDIZE_PROCESSES = max(1, int(os.getenv("STANDARDIZE_PROCESSES", str(min(2, available_cpus())))))
+MULTI_FILE_PARTS_PER_CALL = max(1, int(os.getenv("MULTI_FILE_PARTS_PER_CALL", "1")))
+standardize_pool = None
+standardize_pool_pid = None
+standardize_pool_lock = threading.Lock()
+
+def get_standardize_pool():
+    """
+    Process pool for imaging.prepare_document_part(), created on first use in
+    each process. Workers are spawned rather than forked because this process
+    already runs threads (job workers, the model-call loop); they import only
+    the imaging module, not this app.
+    """
+    global standardize_pool, standardize_pool_pid
+    if standardize_pool_pid != os.getpid():
+        with standardize_pool_lock:
+            if standardize_pool_pid != os.getpid():
+                standardize_pool = ProcessPoolExecutor(
+                    max_workers=STANDARDIZE_PROCESSES,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+                standardize_pool_pid = os.getpid()
+    return standardize_pool
+
+def discard_standardize_pool(pool):
+    """
+    Drop a pool that lost a worker (e.g. OOM-killed while decoding a huge
+    HEIC). A broken ProcessPoolExecutor refuses all later work, so the next
+    get_standardize_pool() call builds a fresh one.
+    """
+    global standardize_pool, standardize_pool_pid
+    with standardize_pool_lock:
+        if standardize_pool is pool:
+            standardize_pool = None
+            standardize_pool_pid = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def combine_cache_keys(cache_keys):
+    """Result-cache key of a multi-file document: every file's key, in order, plus the grouping"""
+    hasher = new_cache_hasher()
+    hasher.update(f"{MULTI_PART_INSTRUCTION}\0{MULTI_FILE_PARTS_PER_CALL}\0".encode("utf-8"))
+    for cache_key in cache_keys:
+        hasher.update(cache_key.encode("ascii") + b"\0")
+    return hasher.hexdigest()
+
+def process_files(sources, file_extensions, on_chunk=None, on_progress=None):
+    """
+    Extract one combined Markdown document from several uploaded files.
+
+    Args:
+        sources: Each file's raw bytes or path, in page order.
+        file_extensions: Lowercase extension of each file.
+        on_chunk: Optional callable invoked with each part's text, in order.
+        on_progress: Optional callable invoked with (completed_parts, total_parts).
+
+    Returns:
+        The Markdown of all files, joined in upload order.
+    """
+    file_process_start = time.time()
+
+    standardize_start = time.time()
+    # Retry once in a fresh pool if a worker dies; a second death fails the
+    # job rather than risking the same file in this process
+    for attempt in range(2):
+        pool = get_standardize_pool()
+        try:
+            prepared = list(pool.map(imaging.prepare_document_part, sources, file_extensions))
+            break
+        except BrokenProcessPool as e:
+            discard_standardize_pool(pool)
+            if attempt:
+                raise
+            logger.warning(f"Standardization pool broke, retrying in a new pool: {e}")
+    standardize_duration = time.time() - standardize_start
+    logger.info(
+        f"[TIMING] {len(prepared)} files prepared in {standardize_duration:.3f} seconds "
+        f"on up to {STANDARDIZE_PROCESSES} processes: {sum(len(data) for data, _ in prepared)} bytes"
+    )
+    record_timing("standardize", standardize_duration, kind="multi_file")
+
+    # MULTI_FILE_PARTS_PER_CALL files go to Gemini together; groups run concurrently
+    groups = [
+        prepared[start:start + MULTI_FILE_PARTS_PER_CALL]
+        for start in range(0, len(prepared), MULTI_FILE_PARTS_PER_CALL)
+    ]
+    output_text = extract_parts(groups, on_chunk=on_chunk, on_progress=on_progress)
+
+    total_process_duration = time.time() - file_process_start
+    logger.info(f"[TIMING] Total process_files() duration: {total_process_duration:.3f} seconds")
+    record_timing("process_total", total_process_duration, kind="multi_file")
+    return output_text
+
+# === Upload Pre-Validation ===
+# Cheap checks that run before a job exists, so corrupt files, decompression
+# bombs and huge PDFs fail in milliseconds without a worker slot or model call.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))     # Per file; matches the browser's limit
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(100 * 1024 * 1024)))  # Whole request, refused before it is read
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(100_000_000)))         # Width x height, read from the header
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "100"))
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+
+class UploadTooLarge(RequestEntityTooLarge):
+    """One uploaded file is over MAX_UPLOAD_BYTES; the description is safe to show the user"""
+
+class UploadSpoolFile(tempfile.SpooledTemporaryFile):
+    """
+    Werkzeug's usual spooled file for an uploaded file (memory up to 500KB,
+    then a temporary file), except that it refuses to grow past
+    MAX_UPLOAD_BYTES. Form parsing stops as soon as a file crosses the
+    limit, instead of receiving the rest of it first.
+    """
+
+    def __init__(self, filename):
+        super().__init__(max_size=500 * 1024, mode="rb+")
+        self.filename = os.path.basename(filename or "")
+        self.received_bytes = 0
+
+    def write(self, data):
+        self.received_bytes += len(data)
+        if self.received_bytes > MAX_UPLOAD_BYTES:
+            raise UploadTooLarge(
+                f"{self.filename or 'A file'} is too large. The limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB per file."
+            )
+        return super().write(data)
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpoolFile(filename)
+
+app.request_class = UploadRequest
+
+# ISO base media "ftyp" brands used by HEIC/HEIF photos
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"}
+
+class UploadRejected(Exception):
+    """An upload that failed pre-validation; the message is safe to show the user"""
+
+    def __init__(self, message, reason, status=400):
+        super().__init__(message)
+        self.reason = reason  # Short label for metrics
+        self.status = status
+
+def sniff_file_type(header):
+    """Identify an upload from its first bytes: "jpeg", "png", "webp", "heif", "pdf" or None"""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[4:8] == b"ftyp" and header[8:12] in HEIF_BRANDS:
+        return "heif"
+    # The PDF header may follow a little junk, but must be in the first 1KB
+    if b"%PDF-" in header[:1024]:
+        return "pdf"
+    return None
+
+def open_upload(source):
+    """A readable binary file object for spooled upload bytes or a path"""
+    return io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else open(source, "rb")
+
+def validate_upload(source, file_extension, display_name):
+    """
+    Check one spooled upload without decoding it.
+
+    Sniffs the real file type from its magic bytes, reads image dimensions
+    from the header (Pillow opens images lazily) and counts PDF pages.
+
+    Returns:
+        A short description for logging, e.g. "jpeg 4032x3024".
+
+    Raises:
+        UploadRejected: When the file is unreadable or over a limit.
+    """
+    with open_upload(source) as file:
+        file_type = sniff_file_type(file.read(1024))
+        if file_type is None:
+            raise UploadRejected(f"{display_name} is not a supported image or PDF, or it is damaged.", "unknown_type")
+        if (file_type == "pdf") != (file_extension == ".pdf"):
+            raise UploadRejected(f"The contents of {display_name} do not match its file type.", "type_mismatch")
+        file.seek(0)
+
+        if file_type == "pdf":
+            if not PYPDF_AVAILABLE:
+                return "pdf"  # Pages cannot be counted without pypdf; the model call still caps the work
+            try:
+                reader = pypdf.PdfReader(file)
+                if reader.is_encrypted and not reader.decrypt(""):
+                    raise UploadRejected(f"{display_name} is password-protected.", "encrypted")
+                page_count = len(reader.pages)
+            except UploadRejected:
+                raise
+            except Exception:
+                raise UploadRejected(f"{display_name} could not be read. It may be damaged.", "corrupt")
+            if page_count == 0:
+                raise UploadRejected(f"{display_name} has no pages.", "corrupt")
+            if page_count > MAX_PDF_PAGES:
+                raise UploadRejected(
+                    f"{display_name} has {page_count} pages. The limit is {MAX_PDF_PAGES} pages.", "too_many_pages"
+                )
+            return f"pdf {page_count} pages"
+
+        if file_type == "heif":
+            ensure_heif_support()
+        try:
+            # Image.open only parses the header; no pixels are decoded
+            with Image.open(file) as img:
+                width, height = img.size
+        except Image.DecompressionBombError:
+            raise UploadRejected(f"{display_name} has too many pixels to process.", "too_many_pixels")
+        except Exception:
+            raise UploadRejected(f"{display_name} could not be read. It may be damaged.", "corrupt")
+        if width * height > MAX_IMAGE_PIXELS:
+            raise UploadRejected(
+                f"{display_name} is {width}x{height} pixels, which is too large to process. "
+                f"Please use a smaller photo.", "too_many_pixels"
+            )
+        return f"{file_type} {width}x{height}"
+
+@app.errorhandler(413)
+def request_too_large(error):
+    # Flask refuses bodies over MAX_CONTENT_LENGTH before reading them, and
+    # UploadSpoolFile stops reading at the first file over MAX_UPLOAD_BYTES
+    metrics.inc("uploads_rejected_total", reason="too_large")
+    if isinstance(error, UploadTooLarge):
+        return jsonify({"error": error.description}), 413
+    return jsonify({"error": f"Upload is too large. The limit is {MAX_REQUEST_BYTES // (1024 * 1024)} MB."}), 413
+
+# === Helper Function: Spool Upload ===
+UPLOAD_MEMORY_LIMIT_BYTES = int(os.getenv("UPLOAD_MEMORY_LIMIT_BYTES", str(10 * 1024 * 1024)))  # 10MB per request
+UPLOAD_MEMORY_TOTAL_BYTES = int(os.getenv("UPLOAD_MEMORY_TOTAL_BYTES", str(64 * 1024 * 1024)))  # All pending jobs of this process
+
+# Upload bytes held in memory by jobs that have not finished yet. Each queued
+# job pins its in-memory uploads until it runs, so without a process-wide cap
+# full queues could hold UPLOAD_MEMORY_LIMIT_BYTES per waiting job.
+upload_memory_in_use = 0
+upload_memory_lock = threading.Lock()
+
+def reserve_upload_memory(wanted):
+    """Claim up to `wanted` bytes of UPLOAD_MEMORY_TOTAL_BYTES; returns the bytes granted, possibly 0"""
+    global upload_memory_in_use
+    with upload_memory_lock:
+        granted = max(0, min(wanted, UPLOAD_MEMORY_TOTAL_BYTES - upload_memory_in_use))
+        upload_memory_in_use += granted
+    return granted
+
+def release_upload_memory(amount):
+    global upload_memory_in_use
+    with upload_memory_lock:
+        upload_memory_in_use -= amount
+
+metrics.describe("upload_memory_bytes", "Upload bytes held in memory by pending jobs")
+metrics.gauge("upload_memory_bytes", lambda: {(): upload_memory_in_use})
+
+def spool_upload(file_storage, filepath, memory_limit=UPLOAD_MEMORY_LIMIT_BYTES):
+    """
+    Copy an uploaded file out of the parsed form data for the job.
+
+    Werkzeug has already received the file into an UploadSpoolFile by the
+    time the route runs, so it is within MAX_UPLOAD_BYTES, and that copy is
+    gone once the request ends. The bytes are hashed for the result cache while
+    being copied. A file of up to memory_limit bytes is kept in memory;
+    larger ones are written to `filepath`. The upload route passes what it
+    reserved with reserve_upload_memory() and has not used for earlier files.
+
+    Returns:
+        (bytes or None, cache_key): the upload bytes when kept in memory
+        (None when written to filepath), and its result-cache key.
+    """
+    hasher = new_cache_hasher()
+    buffer = io.BytesIO()
+    spill_file = None
+    try:
+        for block in iter(lambda: file_storage.stream.read(1024 * 1024), b""):
+            hasher.update(block)
+            if spill_file is None and buffer.tell() + len(block) > memory_limit:
+                # Too big to hold: move what we have so far to disk and continue there
+                spill_file = open(filepath, "wb")
+                spill_file.write(buffer.getvalue())
+                buffer = None
+            (spill_file or buffer).write(block)
+    finally:
+        if spill_file is not None:
+            spill_file.close()
+
+    upload_bytes = buffer.getvalue() if spill_file is None else None
+    return upload_bytes, hasher.hexdigest()
+
 # === Flask Route: Homepage ===
 @app.route("/")
 def index():
     return render_template("index.html")  # Loads index.html from templates folder
 
-# === Flask Route: Image Upload Endpoint (Async) ===
-@app.route("/upload", methods=["POST"])
-def upload_file():
-    # Validate presence of file
-    if "file" not in request.files:
-        return jsonify({"error": "No file uploaded"}), 400
-
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"error": "No selected file"}), 400
+# === Helper Function: Prepare Upload Path ===
+def prepare_upload_path(original_filename):
+    """
+    Sanitize an uploaded filename and choose a unique path for it in the
+    uploads folder.
 
-    # Sanitize filename to prevent path traversal attacks
-    original_filename = file.filename
-    if not original_filename:
-        return jsonify({"error": "Invalid filename"}), 400
-    
+    Returns:
+        (file_extension, filepath, error): error is a message for a 400
+        response, in which case the other values are None.
+    """
     # Get only the basename to prevent path traversal
     safe_basename = os.path.basename(original_filename)
     
@@ -337,7 +2406,7 @@ def upload_file():
     # Validate file extension is allowed
     allowed_extensions = ('.jpg', '.jpeg', '.png', '.heic', '.heif', '.webp', '.pdf')
     if not file_extension or file_extension not in allowed_extensions:
-        return jsonify({"error": "File type not allowed. Supported formats: JPG, PNG, HEIC, WebP, PDF"}), 400
+        return None, None, "File type not allowed. Supported formats: JPG, PNG, HEIC, WebP, PDF"
     
     # Generate unique filename with the validated extension
     unique_filename = f"{uuid.uuid4().hex}{file_extension}"
@@ -350,47 +2419,246 @@ def upload_file():
     try:
         filepath.resolve().relative_to(upload_folder.resolve())
     except ValueError:
-        return jsonify({"error": "Invalid file path"}), 400
-    
-    # Save file to uploads folder
+        return None, None, "Invalid file path"
+    return file_extension, filepath, None
+
+# === Flask Route: Image Upload Endpoint (Async) ===
+@app.route("/upload", methods=["POST"])
+def upload_file():
+    # Validate presence of file; several "file" fields make one multi-page document
+    files = request.files.getlist("file")
+    if not files:
+        return jsonify({"error": "No file uploaded"}), 400
+    if len(files) > MAX_UPLOAD_FILES:
+        return jsonify({"error": f"Too many files. Upload at most {MAX_UPLOAD_FILES} at once."}), 400
+
+    uploads = []  # (original_filename, file_extension, filepath) per file, in upload order
+    for file in files:
+        if file.filename == "":
+            return jsonify({"error": "No selected file"}), 400
+
+        # Sanitize filename to prevent path traversal attacks
+        original_filename = file.filename
+        if not original_filename:
+            return jsonify({"error": "Invalid filename"}), 400
+
+        file_extension, filepath, path_error = prepare_upload_path(original_filename)
+        if path_error:
+            return jsonify({"error": path_error}), 400
+        uploads.append((original_filename, file_extension, filepath))
+
+    memory_held = 0  # Bytes of this request's uploads kept in memory, counted in upload_memory_in_use
+
+    def remove_upload_files():
+        # Called once the uploads are no longer needed, whichever way the request or job ends
+        nonlocal memory_held
+        release_upload_memory(memory_held)
+        memory_held = 0
+        for _, _, filepath in uploads:
+            if filepath.exists():
+                filepath.unlink()
+
+    def reject_upload(rejection):
+        remove_upload_files()
+        metrics.inc("uploads_rejected_total", reason=rejection.reason)
+        logger.info(f"Rejected upload: {rejection}")
+        return jsonify({"error": str(rejection)}), rejection.status
+
+    # Copy each upload once, hashing it on the way; small files stay in memory
+    # while the process-wide budget allows, the rest go to the uploads folder
+    documents = []
+    cache_keys = []
+    memory_left = reserve_upload_memory(UPLOAD_MEMORY_LIMIT_BYTES)  # Shared by every file of this request
     try:
-        file.save(str(filepath))
+        for file, (_, _, filepath) in zip(files, uploads):
+            upload_bytes, part_cache_key = spool_upload(file, filepath, memory_limit=memory_left)
+            if upload_bytes is not None:
+                memory_left -= len(upload_bytes)
+                memory_held += len(upload_bytes)
+            documents.append(upload_bytes if upload_bytes is not None else str(filepath))
+            cache_keys.append(part_cache_key)
+            upload_size = len(upload_bytes) if upload_bytes is not None else filepath.stat().st_size
+            metrics.inc("bytes_total", upload_size, direction="client_upload")
     except Exception as save_error:
         logger.error(f"Error saving file: {str(save_error)}")
+        remove_upload_files()
         return jsonify({"error": "Failed to save file. Please try again."}), 500
+    finally:
+        release_upload_memory(memory_left)  # Hand the unused part of the reservation back
 
-    # Create job and start background processing
-    job_id = create_job()
-    logger.info(f"Created job {job_id} for file {original_filename}")
+    # Reject unreadable or oversized files before a job, worker or model call is spent on them
+    validate_start = time.time()
+    try:
+        descriptions = [
+            validate_upload(document, extension, os.path.basename(name))
+            for document, (name, extension, _) in zip(documents, uploads)
+        ]
+    except UploadRejected as rejection:
+        return reject_upload(rejection)
+    validate_duration = time.time() - validate_start
+    logger.info(f"[TIMING] Upload validated in {validate_duration:.3f} seconds: {', '.join(descriptions)}")
+    record_timing("validate", validate_duration)
+
+    if len(uploads) == 1:
+        original_filename, file_extension, _ = uploads[0]
+        # Split PDFs are extracted part by part, so the split settings shape the output
+        cache_key = pdf_cache_key(cache_keys[0]) if file_extension == ".pdf" else cache_keys[0]
+    else:
+        original_filename = f"{uploads[0][0]} (+{len(uploads) - 1} more)"
+        file_extension = None
+        cache_key = combine_cache_keys(cache_keys)
+
+    # Read here: the background job has no request to take the cookie from
+    owner = document_owner(issue=True) if document_store is not None else None
+
+    cached_result = get_cached_result(cache_key)
+    metrics.inc("cache_lookups_total", cache="result", result="hit" if cached_result is not None else "miss")
+    if cached_result is None and document_store is not None:
+        # Evicted from the result cache but still in the reader's document history
+        cached_result = get_stored_document(cache_key)
+        metrics.inc("cache_lookups_total", cache="document_store", result="hit" if cached_result is not None else "miss")
+    if cached_result is not None:
+        job_id = create_job()
+        if cached_result["reading_view"] is None and READING_VIEW_ENABLED:
+            # Entry predates the reading view: build it once and keep it with the result
+            cached_result["reading_view"] = safe_build_reading_view(cached_result["markdown"])
+            store_cached_result(cache_key, cached_result["markdown"], cached_result["reading_view"])
+        result = {
+            "markdown": cached_result["markdown"],
+            "reading_view": cached_result["reading_view"],
+            "filename": original_filename
+        }
+        if document_store is not None:
+            result["document_id"] = cache_key
+        update_job(job_id, status="completed", result=result)
+        remember_document(cache_key, job_id, [owner], original_filename, result["markdown"], result["reading_view"])
+        metrics.inc("jobs_total", outcome="cached")
+        logger.info(f"[CACHE] Hit for job {job_id} ({original_filename})")
+        remove_upload_files()
+        return jsonify({
+            "job_id": job_id,
+            "status": "completed",
+            "result": present_result(result, wants_reading_view())
+        }), 200
+
+    # Join an identical upload that is already being processed, so a
+    # classroom burst of the same worksheet costs one model call
+    with inflight_extractions_lock:
+        inflight = inflight_extractions.get(cache_key)
+        if inflight is None:
+            # Create job and start background processing
+            job_id = create_job()
+            inflight_extractions[cache_key] = (job_id, [owner])
+            shared_job_id = None
+        else:
+            shared_job_id, owners = inflight
+            if owner not in owners:
+                owners.append(owner)  # Recorded in this reader's history when the job completes
+    if shared_job_id is not None:
+        remove_upload_files()
+        metrics.inc("coalesced_requests_total", kind="extraction")
+        update_job(shared_job_id, shared=True)
+        logger.info(f"[JOB {shared_job_id}] Shared with identical upload {original_filename}")
+        return jsonify({
+            "job_id": shared_job_id,
+            "status": "processing",
+            "shared": True,
+            "queue_position": get_queue_position(shared_job_id)
+        }), 202
+
+    logger.info(f"Created job {job_id} for {len(uploads)} file(s): {original_filename}")
+
+    def release_inflight():
+        """Stop attaching uploads to this job; returns the owners attached so far"""
+        with inflight_extractions_lock:
+            inflight = inflight_extractions.get(cache_key)
+            if inflight is None or inflight[0] != job_id:
+                return []
+            del inflight_extractions[cache_key]
+            return inflight[1]
     
-    # Start background thread to process file
+    # Run the job on a bounded worker pool instead of a thread per request
     def process_in_background():
         try:
             logger.info(f"[JOB {job_id}] Starting file processing")
-            extracted_markdown = process_file(str(filepath))
-            update_job(job_id, status="completed", result={
+            partial_chunks = []
+            published_at = 0.0
+
+            def publish_chunk(text):
+                # Expose the Markdown received so far to /stream listeners. Each
+                # publish rewrites the whole partial text in the job store, so it
+                # happens at most every STREAM_PUBLISH_INTERVAL_SECONDS rather than
+                # per chunk; the completed result carries whatever is left
+                nonlocal published_at
+                partial_chunks.append(text)
+                now = time.time()
+                if now - published_at >= STREAM_PUBLISH_INTERVAL_SECONDS:
+                    published_at = now
+                    update_job(job_id, partial_markdown="".join(partial_chunks))
+
+            def publish_progress(completed_parts, total_parts):
+                update_job(job_id, progress={
+                    "completed_parts": completed_parts,
+                    "total_parts": total_parts
+                })
+
+            if len(documents) == 1:
+                extracted_markdown = process_file(
+                    documents[0],
+                    on_chunk=publish_chunk,
+                    on_progress=publish_progress,
+                    file_extension=file_extension
+                )
+            else:
+                extracted_markdown = process_files(
+                    documents,
+                    [extension for _, extension, _ in uploads],
+                    on_chunk=publish_chunk,
+                    on_progress=publish_progress
+                )
+            reading_view = safe_build_reading_view(extracted_markdown)
+            # Cache before releasing the in-flight slot so later uploads hit the cache
+            store_cached_result(cache_key, extracted_markdown, reading_view)
+            owners = release_inflight()
+            remember_document(cache_key, job_id, owners, original_filename, extracted_markdown, reading_view)
+            result = {
                 "markdown": extracted_markdown,
+                "reading_view": reading_view,
                 "filename": original_filename
-            })
+            }
+            if document_store is not None:
+                result["document_id"] = cache_key
+            update_job(job_id, status="completed", result=result, partial_markdown=None)
+            metrics.inc("jobs_total", outcome="completed")
             logger.info(f"[JOB {job_id}] Processing completed")
         except Exception as e:
             logger.error(f"[JOB {job_id}] Error processing file: {str(e)}")
             update_job(job_id, status="failed", error=str(e))
+            metrics.inc("jobs_total", outcome="failed")
         finally:
-            # Clean up file
-            if filepath.exists():
-                filepath.unlink()
-            # Clean up old jobs periodically
-            cleanup_old_jobs()
+            release_inflight()
+            # Clean up files
+            remove_upload_files()
     
-    thread = threading.Thread(target=process_in_background)
-    thread.daemon = True
-    thread.start()
+    # Multi-file documents are long multi-part jobs, like PDFs
+    job_queue = job_queues["pdf" if file_extension == ".pdf" or len(uploads) > 1 else "image"]
+    try:
+        job_queue.submit(job_id, process_in_background)
+    except QueueFullError as e:
+        logger.warning(f"[JOB {job_id}] Rejected: {e}")
+        metrics.inc("jobs_total", outcome="rejected")
+        release_inflight()
+        update_job(job_id, status="failed", error="Server is busy")
+        remove_upload_files()
+        response = jsonify({"error": "The server is busy. Please try again in a moment."})
+        response.headers["Retry-After"] = str(QUEUE_RETRY_AFTER_SECONDS)
+        return response, 503
     
-    # Return immediately with job ID
+    # Return immediately with job ID and current place in line
     return jsonify({
         "job_id": job_id,
-        "status": "processing"
+        "status": "processing",
+        "queue_position": job_queue.position(job_id)
     }), 202  # 202 Accepted status code
 
 # === Flask Route: Check Job Status ===
@@ -399,49 +2667,152 @@ def get_job_status(job_id):
     job = get_job(job_id)
     
     if not job:
-        return jsonify({"error": "Job not found"}), 404
+        # An expired job can still be answered from the document history
+        info = document_store.resolve(job_id) if document_store is not None else None
+        result = load_document_result(info) if info else None
+        if result is None:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify({"status": "completed", "result": present_result(result, wants_reading_view())})
     
     response = {
         "status": job["status"]
     }
+    if TRACE_REQUESTS and job.get("trace_id"):
+        response["trace_id"] = job["trace_id"]
+    if job.get("shared"):
+        # Identical uploads were attached to this job instead of starting their own
+        response["shared"] = True
     
     if job["status"] == "completed":
-        response["result"] = job["result"]
+        response["result"] = present_result(job["result"], wants_reading_view())
     elif job["status"] == "failed":
         response["error"] = job["error"]
+    else:
+        # Position in line while waiting for a worker; None once running
+        response["queue_position"] = get_queue_position(job_id)
+        # Per-part progress for PDFs that were split for parallel extraction
+        if job.get("progress"):
+            response["progress"] = job["progress"]
     
     return jsonify(response)
 
-# === Flask Route: Context-Based Word Definition ===
-@app.route("/get-definition", methods=["POST"])
-def get_definition():
-    try:
-        data = request.get_json()
-        logger.info(f"Received data: {data}")  # Log raw incoming request
-
-        # Input validation
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
-
-        word = data.get("word to define", "").strip()
-        context = data.get("context sentence", "").strip()
+# === Flask Route: Stream Job Output (Server-Sent Events) ===
+STREAM_TIMEOUT_SECONDS = int(os.getenv("STREAM_TIMEOUT_SECONDS", "300"))
+# Shortest gap between partial-Markdown writes to the job store while a job streams
+STREAM_PUBLISH_INTERVAL_SECONDS = float(os.getenv("STREAM_PUBLISH_INTERVAL_SECONDS", "0.25"))
 
-        if not word:
-            return jsonify({"error": "Word to define is required"}), 400
-        if not context:
-            return jsonify({"error": "Context sentence is required"}), 400
+def format_sse(event, data):
+    """Encode one Server-Sent Event; JSON keeps multi-line Markdown on a single data line"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-        logger.info(f"Processing definition for word: '{word}' with context: '{context}'")
-
-        # Compose user input into a single message
-        user_prompt = f"""WORD TO DEFINE:
-{word}
-CONTEXT SENTENCE:
-{context}"""
-        text_prompt = types.Part.from_text(text=user_prompt)
+@app.route("/stream/<job_id>", methods=["GET"])
+def stream_job(job_id):
+    if not get_job(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    include_reading_view = wants_reading_view()
+
+    def generate():
+        sent_length = 0
+        last_position = None
+        last_progress = None
+        deadline = time.time() + STREAM_TIMEOUT_SECONDS
+        while time.time() < deadline:
+            job = get_job(job_id)
+            if not job:
+                yield format_sse("error", {"error": "Job not found"})
+                return
+
+            if job["status"] == "completed":
+                markdown = job["result"]["markdown"]
+                if len(markdown) > sent_length:
+                    yield format_sse("chunk", {"text": markdown[sent_length:]})
+                yield format_sse("done", {"result": present_result(job["result"], include_reading_view)})
+                return
+            if job["status"] == "failed":
+                yield format_sse("error", {"error": job["error"]})
+                return
+
+            position = get_queue_position(job_id)
+            if position != last_position:
+                yield format_sse("queued", {"queue_position": position})
+                last_position = position
+
+            progress = job.get("progress")
+            if progress and progress != last_progress:
+                yield format_sse("progress", progress)
+                last_progress = progress
+
+            partial = job.get("partial_markdown") or ""
+            if len(partial) > sent_length:
+                yield format_sse("chunk", {"text": partial[sent_length:]})
+                sent_length = len(partial)
+
+            with job_update_condition:
+                job_update_condition.wait(timeout=0.5)
+
+        yield format_sse("error", {"error": "Processing timed out. Please try again."})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Stop proxies from buffering the stream
+        }
+    )
 
-        # Define system behavior for this task
-        system_instruction = types.Part.from_text(text="""You are an expert at communicating and teaching vocabulary to adults in a simple and encouraging way.
+# === Flask Route: Document History ===
+@app.route("/documents", methods=["GET"])
+def list_documents():
+    """The caller's recent documents, newest first; only API-key clients and browsers with a reader_id have a history"""
+    if document_store is None:
+        return jsonify({"error": "Document history is not enabled"}), 404
+    owner = document_owner()
+    if owner is None:
+        return jsonify({"documents": []})
+    try:
+        limit = min(max(int(request.args.get("limit", "20")), 1), DOCUMENT_LIST_MAX)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    return jsonify({"documents": document_store.recent(owner, limit)})
+
+@app.route("/documents/<document_id>", methods=["GET"])
+def get_document(document_id):
+    """Re-open a stored document by content hash or job ID, with conditional GET"""
+    if document_store is None:
+        return jsonify({"error": "Document history is not enabled"}), 404
+    info = document_store.resolve(document_id)
+    if info is None:
+        return jsonify({"error": "Document not found"}), 404
+
+    # The content hash covers the file, model and prompt, so it names the
+    # Markdown exactly; a matching If-None-Match is answered from the index
+    # without reading the compressed file
+    include_reading_view = wants_reading_view()
+    etag = f"{info['document_id']}-reading" if include_reading_view else info["document_id"]
+    if request.if_none_match.contains_weak(etag):
+        metrics.inc("document_store_reads_total", result="not_modified")
+        response = Response(status=304)
+    else:
+        result = load_document_result(info)
+        if result is None:
+            metrics.inc("document_store_reads_total", result="missing")
+            return jsonify({"error": "Document not found"}), 404
+        metrics.inc("document_store_reads_total", result="read")
+        response = jsonify({
+            "document_id": info["document_id"],
+            "created_at": info["created_at"],
+            "result": present_result(result, include_reading_view)
+        })
+    # Weak, because the filename shown may differ between uploads of the same file
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+# === Definition Prompt and Model ===
+DEFINITION_MODEL = "gemini-2.5-flash-lite"  # Fast model for word definitions
+DEFINITION_CALL_POLICY = CallPolicy.from_env("DEFINITION", DEFINITION_MODEL, default_timeout=30, default_hedge_after=5)
+DEFINITION_SYSTEM_PROMPT = """You are an expert at communicating and teaching vocabulary to adults in a simple and encouraging way.
 
 **Instructions:**
 1.  Your primary task is to define the word provided in the "WORD TO DEFINE" field. You must only define this word.
@@ -488,40 +2859,432 @@ The interest on your savings account will accrue monthly.
 **Output:**
 Accrue means to build up or be added over time. In this context, it means the extra money from interest is added to your savings account each month, helping it grow.
 ---
-""")
+"""
+
+# Builtin answers for the common grammatical words the system prompt already
+# special-cases. These explain the word's job generally, so they are served
+# without a model call whatever the context sentence is.
+FUNCTION_WORD_DEFINITIONS = {
+    "the": "'The' is a word that points to one certain thing. It tells you the writer means a specific person, place, or thing that you already know about.",
+    "a": "'A' is a word that points to one thing, but not a certain one. It means 'one' or 'any one' of something.",
+    "an": "'An' means the same as 'a'. We use 'an' before words that start with a vowel sound, like 'an apple' or 'an hour'.",
+    "of": "'Of' is a word that connects things together. It often shows that something belongs to or is part of something else, like 'the door of the house'.",
+    "with": "'With' is a word that connects things together. It shows that people or things are together, or what is used to do something.",
+    "is": "'Is' is a form of the word 'be'. It connects a person or thing to what it is or what it is like, like 'the rent is due'.",
+    "are": "'Are' is a form of the word 'be'. It connects more than one person or thing to what they are or what they are like.",
+    "was": "'Was' is a form of the word 'be' that talks about the past. It tells you how something used to be.",
+    "and": "'And' is a word that joins two things together. It means 'also' or 'plus'.",
+    "or": "'Or' is a word that gives a choice between two or more things.",
+    "but": "'But' is a word that shows a change or a difference. It tells you the next part is different from what came before.",
+    "to": "'To' is a word that shows direction or purpose. It can show where something is going, or it can come before an action word, like 'to pay'.",
+    "in": "'In' is a word that shows where something is. It means inside something, or during a time, like 'in May'.",
+    "on": "'On' is a word that shows where something is. It means touching the top of something, or on a certain day, like 'on Monday'.",
+    "at": "'At' is a word that points to an exact place or time, like 'at the office' or 'at 3 o'clock'.",
+    "for": "'For' is a word that shows who gets something or why something happens, like 'a letter for you'.",
+    "by": "'By' is a word that shows who did something, or a deadline, like 'pay by Friday'.",
+    "from": "'From' is a word that shows where something starts or comes from, like 'a letter from the bank'.",
+    "it": "'It' is a word that stands in for a thing that was already talked about, so you do not have to say its name again.",
+    "as": "'As' is a word that compares things or shows a role, like 'as fast as' or 'working as a cook'.",
+}
+
+# === Definition Cache: In-Process LRU with Optional Shared Disk Tier ===
+DEFINITION_CACHE_SIZE = int(os.getenv("DEFINITION_CACHE_SIZE", "5000"))
+DEFINITION_CACHE_TTL_SECONDS = int(os.getenv("DEFINITION_CACHE_TTL_SECONDS", str(24 * 3600)))
+DEFINITION_CACHE_PATH = os.getenv("DEFINITION_CACHE_PATH")  # Unset disables the disk tier
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries also expire after ttl_seconds"""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (stored_at, value), oldest first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class SqliteDefinitionCache:
+    """Definition cache in a SQLite file so every gunicorn worker shares hits"""
+
+    def __init__(self, path, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.connections = SqliteConnections(path)
+        conn = self.connections.get()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS definitions ("
+            "cache_key TEXT PRIMARY KEY, stored_at REAL NOT NULL, definition TEXT NOT NULL)"
+        )
 
-        # Build the request content
-        contents = [
-            types.Content(
-                role="user",
-                parts=[text_prompt]
-            )
-        ]
+    def get(self, key):
+        row = self.connections.get().execute(
+            "SELECT definition FROM definitions WHERE cache_key = ? AND stored_at > ?",
+            (key, time.time() - self.ttl_seconds)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        conn = self.connections.get()
+        conn.execute(
+            "INSERT OR REPLACE INTO definitions (cache_key, stored_at, definition) VALUES (?, ?, ?)",
+            (key, time.time(), value)
+        )
+        # Opportunistically drop expired rows so the file does not grow forever
+        conn.execute("DELETE FROM definitions WHERE stored_at < ?", (time.time() - self.ttl_seconds,))
+
+definition_cache = TTLCache(DEFINITION_CACHE_SIZE, DEFINITION_CACHE_TTL_SECONDS)
+definition_disk_cache = (
+    SqliteDefinitionCache(DEFINITION_CACHE_PATH, DEFINITION_CACHE_TTL_SECONDS)
+    if DEFINITION_CACHE_PATH else None
+)
+
+def normalize_word(word):
+    """Lowercase a word and strip surrounding punctuation ("The," -> "the")"""
+    return word.strip().strip(".,;:!?\"'()[]{}“”‘’").lower()
+
+def is_function_word_use(word, context):
+    """
+    Whether a word can take the builtin function-word answer: it must be
+    lowercase, or capitalized only because it starts a sentence. "IT
+    department", "Vitamin A" and "Plan A" are names, not a pronoun or an
+    article, and go to the model.
+    """
+    token = word.strip().strip(".,;:!?\"'()[]{}“”‘’")
+    if token == token.lower():
+        return True
+    if token != token.capitalize():
+        return False
+    # The first letter is capital: allow it only where a sentence begins
+    sentence_start = re.compile(r"(?:^|[.!?:][\"'”’)\]]*\s+)[\"'“‘(\[]*" + re.escape(token) + r"\b")
+    return sentence_start.search(context.strip()) is not None
+
+def definition_cache_key(word, context):
+    """Key a definition on the normalized word and whitespace-collapsed context"""
+    normalized_context = " ".join(context.split()).lower()
+    hasher = hashlib.sha256()
+    for value in (DEFINITION_MODEL, DEFINITION_SYSTEM_PROMPT, normalize_word(word), normalized_context):
+        hasher.update(value.encode("utf-8") + b"\0")
+    return hasher.hexdigest()
+
+async def generate_definition_async(word, context):
+    """Ask Gemini to define a word in its context sentence (runs on the model loop)"""
+    # Compose user input into a single message
+    user_prompt = f"""WORD TO DEFINE:
+{word}
+CONTEXT SENTENCE:
+{context}"""
+    text_prompt = types.Part.from_text(text=user_prompt)
+
+    # Define system behavior for this task
+    system_instruction = types.Part.from_text(text=DEFINITION_SYSTEM_PROMPT)
 
-        # Configure generation settings
-        config = types.GenerateContentConfig(
-            temperature=0.2,  # Allows more natural explanations
-            top_p=0.95,
-            max_output_tokens=8192,
-            response_modalities=["TEXT"],
-            safety_settings=[  # Apply moderation filters
-                types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_LOW_AND_ABOVE"),
-                types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_LOW_AND_ABOVE"),
-                types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_LOW_AND_ABOVE"),
-                types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_LOW_AND_ABOVE")
-            ],
-            system_instruction=[system_instruction],
+    # Build the request content
+    contents = [
+        types.Content(
+            role="user",
+            parts=[text_prompt]
+        )
+    ]
+
+    # Configure generation settings
+    config = types.GenerateContentConfig(
+        temperature=0.2,  # Allows more natural explanations
+        top_p=0.95,
+        max_output_tokens=8192,
+        response_modalities=["TEXT"],
+        safety_settings=[  # Apply moderation filters
+            types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_LOW_AND_ABOVE"),
+            types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_LOW_AND_ABOVE"),
+            types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_LOW_AND_ABOVE"),
+            types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_LOW_AND_ABOVE")
+        ],
+        system_instruction=[system_instruction],
+    )
+
+    # Call Gemini and stream the result
+    definition_start = time.time()
+    output_text = await model_caller.stream_with_policy(DEFINITION_CALL_POLICY, contents, config)
+    record_timing("definition_model", time.time() - definition_start, model=DEFINITION_MODEL)
+    return output_text
+
+def generate_definition(word, context):
+    """Ask Gemini to define a word in its context sentence"""
+    return model_caller.call(generate_definition_async(word, context))
+
+def get_cached_definition(word, context):
+    """
+    Resolve a definition from the builtin table, the in-process cache, or the
+    shared disk cache. Returns None when a model call is needed.
+    """
+    builtin = FUNCTION_WORD_DEFINITIONS.get(normalize_word(word)) if is_function_word_use(word, context) else None
+    if builtin:
+        metrics.inc("cache_lookups_total", cache="definition", result="builtin")
+        return builtin
+
+    cache_key = definition_cache_key(word, context)
+    definition = definition_cache.get(cache_key)
+    if definition is not None:
+        logger.info(f"[CACHE] Definition hit (memory) for '{word}'")
+        metrics.inc("cache_lookups_total", cache="definition", result="memory")
+        return definition
+
+    if definition_disk_cache:
+        try:
+            definition = definition_disk_cache.get(cache_key)
+        except sqlite3.Error as e:
+            logger.warning(f"[CACHE] Definition disk cache read failed: {e}")
+        if definition is not None:
+            logger.info(f"[CACHE] Definition hit (disk) for '{word}'")
+            metrics.inc("cache_lookups_total", cache="definition", result="disk")
+            definition_cache.set(cache_key, definition)
+            return definition
+    metrics.inc("cache_lookups_total", cache="definition", result="miss")
+    return None
+
+def store_definition(word, context, definition):
+    """Save a freshly generated definition in both cache tiers"""
+    if not definition:
+        return
+    cache_key = definition_cache_key(word, context)
+    definition_cache.set(cache_key, definition)
+    if definition_disk_cache:
+        try:
+            definition_disk_cache.set(cache_key, definition)
+        except sqlite3.Error as e:
+            logger.warning(f"[CACHE] Definition disk cache write failed: {e}")
+
+# Concurrent lookups of the same word in the same context share one model call
+definition_flights = SingleFlight("definition")
+
+def lookup_definition(word, context):
+    """Return a cached definition, or generate one with Gemini and cache it"""
+    definition = get_cached_definition(word, context)
+    if definition is not None:
+        return definition
+
+    def generate_and_store():
+        generated = generate_definition(word, context)
+        store_definition(word, context, generated)
+        return generated
+
+    return definition_flights.do(definition_cache_key(word, context), generate_and_store)
+
+async def lookup_definition_async(word, context):
+    """Async lookup_definition() for ASGI handlers; never blocks the caller's event loop on Gemini"""
+    definition = get_cached_definition(word, context)
+    if definition is not None:
+        return definition
+
+    cache_key = definition_cache_key(word, context)
+    future, is_leader = definition_flights.begin(cache_key)
+    if not is_leader:
+        # shield() keeps one disconnecting follower from cancelling the shared call
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    async def generate_and_store():
+        try:
+            generated = await model_caller.call_async(generate_definition_async(word, context))
+        except BaseException as e:
+            definition_flights.finish(cache_key, future, error=e)
+            raise
+        store_definition(word, context, generated)
+        definition_flights.finish(cache_key, future, result=generated)
+        return generated
+
+    # Run as its own task so followers still get an answer if the leader's
+    # client disconnects
+    return await asyncio.shield(asyncio.ensure_future(generate_and_store()))
+
+# === Batch Definitions for Prefetching ===
+DEFINITION_BATCH_SIZE = int(os.getenv("DEFINITION_BATCH_SIZE", "20"))          # Items per model call
+DEFINITION_BATCH_MAX_ITEMS = int(os.getenv("DEFINITION_BATCH_MAX_ITEMS", "200"))  # Items per request
+DEFINITION_FALLBACK_MAX_ITEMS = int(os.getenv("DEFINITION_FALLBACK_MAX_ITEMS", "20"))  # Single calls per request
+
+DEFINITION_BATCH_INSTRUCTION = """You will receive a JSON array of items. Each item has an "index", a "word" (the WORD TO DEFINE) and a "context" (the CONTEXT SENTENCE).
+Define every item by following the instructions above, exactly as if it had been sent on its own.
+Respond with only a JSON array of objects of the form {"index": <index>, "definition": "<definition>"}, one per item."""
+
+async def generate_definitions_batch_async(items):
+    """
+    Define several (word, context) pairs with a single Gemini call (runs on the model loop).
+
+    Returns a dict of item index -> definition. Items missing from the
+    response, or every item when the response is not valid JSON, are left
+    out so the caller can fall back to one call per item.
+    """
+    payload = [
+        {"index": index, "word": word, "context": context}
+        for index, (word, context) in enumerate(items)
+    ]
+    contents = [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=json.dumps(payload))]
         )
+    ]
+    config = types.GenerateContentConfig(
+        temperature=0.2,
+        top_p=0.95,
+        max_output_tokens=8192,
+        response_modalities=["TEXT"],
+        response_mime_type="application/json",
+        safety_settings=[
+            types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_LOW_AND_ABOVE"),
+            types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_LOW_AND_ABOVE"),
+            types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_LOW_AND_ABOVE"),
+            types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_LOW_AND_ABOVE")
+        ],
+        system_instruction=[
+            types.Part.from_text(text=DEFINITION_SYSTEM_PROMPT),
+            types.Part.from_text(text=DEFINITION_BATCH_INSTRUCTION)
+        ],
+    )
+
+    batch_start = time.time()
+    response = await model_caller.generate_with_policy(DEFINITION_CALL_POLICY, contents, config)
+    record_timing("definition_batch_model", time.time() - batch_start, model=DEFINITION_MODEL)
 
-        # Call Gemini and stream the result
-        output_text = ""
-        for chunk in client.models.generate_content_stream(
-            model="gemini-2.5-flash-lite",
-            contents=contents,
-            config=config,
-        ):
-            if chunk.text:  # Only add text if it's not None
-                output_text += chunk.text
+    try:
+        parsed = json.loads(response.text or "")
+    except ValueError:
+        logger.warning(f"Batch definition response was not valid JSON ({len(items)} items)")
+        return {}
+    if not isinstance(parsed, list):
+        return {}
+
+    definitions = {}
+    for entry in parsed:
+        if not isinstance(entry, dict):
+            continue
+        index = entry.get("index")
+        definition = entry.get("definition")
+        if isinstance(index, int) and 0 <= index < len(items) and isinstance(definition, str) and definition.strip():
+            definitions[index] = definition.strip()
+    return definitions
+
+def charge_definition_fallback(calls):
+    """
+    Spend definition tokens for single-call fallbacks before making them.
+    Returns False when the client is out of budget and they should be skipped.
+    """
+    client_id = current_client_id.get()
+    if not RATE_LIMIT_ENABLED or not client_id:
+        return True
+    decision = check_rate_limit(client_id, "definition", calls)
+    if has_request_context():
+        g.rate_limit = decision  # Response headers show the budget left after the fallback
+    if not decision.allowed:
+        logger.warning(f"Rate limited {client_id}: skipped {calls} fallback definition calls")
+    return decision.allowed
+
+def lookup_definitions(items):
+    """
+    Resolve many (word, context) pairs, using caches first, then batched
+    model calls, then single calls for anything a batch did not answer.
+
+    Every batch is submitted to the model loop at once, then every single
+    call, so a request waits for the slowest call of each round rather than
+    the sum of them; the per-model semaphores still cap calls in flight.
+    At most DEFINITION_FALLBACK_MAX_ITEMS single calls are made per request,
+    and they are charged to the client's definition budget.
+
+    Returns a list of definitions aligned with items (None where all attempts failed).
+    """
+    results = [get_cached_definition(word, context) for word, context in items]
+
+    # Deduplicate misses so a word repeated in the same sentence is asked once
+    missing = list(dict.fromkeys(
+        (normalize_word(word), " ".join(context.split()))
+        for (word, context), definition in zip(items, results)
+        if definition is None
+    ))
+    resolved = {}
+    batches = [missing[start:start + DEFINITION_BATCH_SIZE] for start in range(0, len(missing), DEFINITION_BATCH_SIZE)]
+    batch_futures = [model_caller.submit(generate_definitions_batch_async(batch)) for batch in batches]
+    fallback = []
+    for batch, future in zip(batches, batch_futures):
+        try:
+            batch_definitions = future.result()
+        except Exception as e:
+            logger.warning(f"Batch definition call failed, falling back to single calls: {e}")
+            batch_definitions = {}
+        for index, key in enumerate(batch):
+            if index in batch_definitions:
+                resolved[key] = batch_definitions[index]
+            else:
+                fallback.append(key)
+
+    if len(fallback) > DEFINITION_FALLBACK_MAX_ITEMS:
+        logger.warning(f"Skipped single-call fallback for {len(fallback) - DEFINITION_FALLBACK_MAX_ITEMS} definitions")
+        fallback = fallback[:DEFINITION_FALLBACK_MAX_ITEMS]
+    if fallback and not charge_definition_fallback(len(fallback)):
+        fallback = []
+
+    single_futures = [model_caller.submit(generate_definition_async(word, context)) for word, context in fallback]
+    for (word, context), future in zip(fallback, single_futures):
+        try:
+            resolved[(word, context)] = future.result()
+        except Exception as e:
+            logger.warning(f"Definition for '{word}' failed: {e}")
+
+    for (word, context), definition in resolved.items():
+        store_definition(word, context, definition)
+
+    for position, (word, context) in enumerate(items):
+        if results[position] is None:
+            results[position] = resolved.get((normalize_word(word), " ".join(context.split())))
+    return results
+
+# === Flask Route: Context-Based Word Definition ===
+def validate_definition_request(data):
+    """
+    Pull the word and context out of a /get-definition body.
+
+    Returns:
+        (word, context, None) when valid, or (None, None, error message).
+    """
+    if not data:
+        return None, None, "No data provided"
+
+    word = data.get("word to define", "").strip()
+    context = data.get("context sentence", "").strip()
+
+    if not word:
+        return None, None, "Word to define is required"
+    if not context:
+        return None, None, "Context sentence is required"
+    return word, context, None
+
+@app.route("/get-definition", methods=["POST"])
+def get_definition():
+    try:
+        data = request.get_json()
+        logger.info(f"Received data: {data}")  # Log raw incoming request
+
+        # Input validation
+        word, context, validation_error = validate_definition_request(data)
+        if validation_error:
+            return jsonify({"error": validation_error}), 400
+
+        logger.info(f"Processing definition for word: '{word}' with context: '{context}'")
+
+        output_text = lookup_definition(word, context)
 
         logger.info(f"Generated definition: {output_text}")
         return jsonify({"definition": output_text})
@@ -530,6 +3293,141 @@ Accrue means to build up or be added over time. In this context, it means the ex
         logger.error(f"Error in get_definition: {str(e)}", exc_info=True)
         return jsonify({"error": "An error occurred while processing your request"}), 500
 
+# === Flask Route: Batch Word Definitions ===
+@app.route("/get-definitions", methods=["POST"])
+def get_definitions():
+    """
+    Define many words at once so the frontend can prefetch a document's hard words.
+
+    Expects {"items": [{"word to define": ..., "context sentence": ...}, ...]}
+    and returns {"definitions": {word: {context sentence: definition}}}, with
+    each word normalized (lowercase, no surrounding punctuation).
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("items"), list):
+            return jsonify({"error": "A list of items is required"}), 400
+
+        items = []
+        for item in data["items"]:
+            if not isinstance(item, dict):
+                continue
+            word = str(item.get("word to define", "")).strip()
+            context = str(item.get("context sentence", "")).strip()
+            if word and context:
+                items.append((word, context))
+
+        if not items:
+            return jsonify({"error": "No valid items provided"}), 400
+        if len(items) > DEFINITION_BATCH_MAX_ITEMS:
+            return jsonify({"error": f"At most {DEFINITION_BATCH_MAX_ITEMS} items are allowed per request"}), 400
+
+        logger.info(f"Processing batch of {len(items)} definitions")
+        definitions = {}
+        for (word, context), definition in zip(items, lookup_definitions(items)):
+            if definition is not None:
+                definitions.setdefault(normalize_word(word), {})[context] = definition
+
+        return jsonify({"definitions": definitions})
+
+    except Exception as e:
+        logger.error(f"Error in get_definitions: {str(e)}", exc_info=True)
+        return jsonify({"error": "An error occurred while processing your request"}), 500
+
+# === Flask Route: Client Usage ===
+@app.route("/usage", methods=["GET"])
+def get_usage():
+    """The calling client's usage totals and what is left in each budget"""
+    client_id = g.client_id
+    budgets = {}
+    for budget, (rate, burst) in RATE_LIMIT_BUDGETS.items():
+        _, tokens, _ = rate_limiter.take(client_id, budget, 0, rate, burst)  # Peek without spending
+        budgets[budget] = {"limit": int(burst), "remaining": int(tokens), "per_minute": rate * 60}
+    return jsonify({
+        "client": client_id,
+        "rate_limits_enabled": RATE_LIMIT_ENABLED,
+        "budgets": budgets,
+        "usage": rate_limiter.usage(client_id)
+    })
+
+# === Flask Route: Metrics (Prometheus Text Format) ===
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# === Startup Report and Readiness ===
+def load_heavy_modules():
+    """Import every deferred module now (used by EAGER_IMPORTS and warm-up)"""
+    for module in (genai, types, genai_errors, Image):
+        module.load()
+    if PYPDF_AVAILABLE:
+        pypdf.load()
+    if MARKDOWN_IT_AVAILABLE:
+        markdown_it.load()
+    ensure_heif_support()
+
+def startup_report():
+    """Startup stages in milliseconds, slowest first"""
+    stages = sorted(STARTUP_TIMINGS.items(), key=lambda item: item[1], reverse=True)
+    return {stage: round(seconds * 1000, 1) for stage, seconds in stages}
+
+def warm_up():
+    """
+    Do the work the first real request would otherwise pay for: heavy
+    imports, the Gemini client, the model-call loop and the job store.
+    Returns a list of problems; empty means this worker is ready.
+    """
+    problems = []
+    try:
+        load_heavy_modules()
+    except Exception as e:
+        problems.append(f"imports: {e}")
+    try:
+        get_genai_client()
+        model_caller.ensure_loop()
+    except Exception as e:
+        problems.append(f"model client: {e}")
+    try:
+        job_store.get("readiness-probe")
+    except Exception as e:
+        problems.append(f"job store: {e}")
+    return problems
+
+# With gunicorn --preload, load heavy modules once in the master so workers
+# share them; the client and loop threads are still created per worker
+if EAGER_IMPORTS:
+    load_heavy_modules()
+
+STARTUP_TIMINGS["import app"] = time.perf_counter() - IMPORT_STARTED_AT
+logger.info(
+    f"[STARTUP] App imported in {STARTUP_TIMINGS['import app'] * 1000:.0f} ms: "
+    + ", ".join(f"{stage} {ms:.0f} ms" for stage, ms in startup_report().items() if stage != "import app")
+)
+
+metrics.describe("startup_stage_seconds", "Time spent in each startup stage of this process")
+metrics.gauge("startup_stage_seconds", lambda: {
+    (("stage", stage),): seconds for stage, seconds in list(STARTUP_TIMINGS.items())
+})
+
+# Point load balancer readiness probes here: the first probe warms the
+# worker up, so user requests never pay for it
+@app.route("/ready", methods=["GET"])
+def get_readiness():
+    problems = warm_up()
+    response = {
+        "ready": not problems,
+        "pid": os.getpid(),
+        "startup_ms": startup_report()
+    }
+    if problems:
+        response["problems"] = problems
+        return jsonify(response), 503
+    return jsonify(response)
+
 # === Run Flask App Server ===
 if __name__ == "__main__":
     # Only run Flask development server when running directly (not through Gunicorn)
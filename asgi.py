@@ -0,0 +1,99 @@
+# === ASGI Entry Point ===
+# Serves /get-definition natively on the event loop, so one process can hold
+# hundreds of waiting definition calls without a thread each. Every other
+# route is handed to the Flask app unchanged.
+#
+# Run with:
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000
+import asyncio                    # To keep rate-limit storage off the event loop
+import json                       # To parse and build request bodies
+import logging                    # For error logging
+
+from asgiref.wsgi import WsgiToAsgi  # Runs the Flask (WSGI) app under ASGI
+
+import app as flask_app
+
+logger = logging.getLogger(__name__)
+
+wsgi_app = WsgiToAsgi(flask_app.app)
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_json(send, status, payload, headers=None):
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("ascii")),
+        ] + [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items()],
+    })
+    await send({"type": "http.response.body", "body": body})
+    return len(body)
+
+
+def client_id_for(scope):
+    """Same client identity the Flask app uses: a known API key, else the (proxied) IP"""
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope.get("headers", [])}
+    remote_addr = scope["client"][0] if scope.get("client") else None
+    forwarded_for = [hop.strip() for hop in headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    hops = flask_app.RATE_LIMIT_TRUSTED_PROXIES
+    if hops and len(forwarded_for) >= hops:
+        remote_addr = forwarded_for[-hops]
+    return flask_app.rate_limit_client_id(headers.get("x-api-key"), remote_addr)
+
+
+async def get_definition(scope, receive, send):
+    """Async twin of the Flask /get-definition route, with the same request and response shape"""
+    client_id = client_id_for(scope)
+    flask_app.current_client_id.set(client_id)
+    headers = {}
+    try:
+        if flask_app.RATE_LIMIT_ENABLED:
+            # The SQLite limiter blocks on disk and on other workers' locks
+            decision = await asyncio.to_thread(flask_app.check_rate_limit, client_id, "definition")
+            headers = flask_app.rate_limit_headers(decision)
+            if not decision.allowed:
+                logger.warning(f"Rate limited {client_id} on /get-definition (definition)")
+                await send_json(send, 429, {"error": "Too many requests. Please wait a moment and try again."}, headers)
+                return
+
+        body = await read_body(receive)
+        try:
+            data = json.loads(body or b"null")
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            data = None
+
+        word, context, validation_error = flask_app.validate_definition_request(data)
+        if validation_error:
+            await send_json(send, 400, {"error": validation_error}, headers)
+            return
+
+        definition = await flask_app.lookup_definition_async(word, context)
+        bytes_out = await send_json(send, 200, {"definition": definition}, headers)
+        if flask_app.RATE_LIMIT_ENABLED:
+            await asyncio.to_thread(
+                flask_app.record_usage, client_id, requests=1, bytes_in=len(body), bytes_out=bytes_out
+            )
+
+    except Exception as e:
+        logger.error(f"Error in async get_definition: {str(e)}", exc_info=True)
+        await send_json(send, 500, {"error": "An error occurred while processing your request"}, headers)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == "/get-definition" and scope["method"] == "POST":
+        await get_definition(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
@@ -0,0 +1,117 @@
+# === Image Standardization Benchmark ===
+# Runs a local corpus of sample images through each standardization profile
+# and reports encode time, output size and peak memory.
+#
+# Usage:
+#   python benchmark_images.py path/to/samples
+#   python benchmark_images.py path/to/samples --profiles fast balanced --repeat 5 --csv results.csv
+import argparse                   # For command line options
+import csv                        # For optional CSV output
+import multiprocessing            # To measure each run in a fresh process
+import os                         # For file handling
+import statistics                 # For median timings
+import sys                        # For platform checks
+import time                       # For timing operations
+
+SUPPORTED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic", ".heif", ".webp")
+
+
+def _peak_rss_bytes():
+    """Peak resident memory of this process so far"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _measure(image_path, profile, repeat):
+    """
+    Standardize one image with one profile in a fresh process.
+
+    Peak memory is the growth of the process's peak RSS across the runs, so
+    it covers Pillow's native buffers that tracemalloc cannot see.
+    """
+    from imaging import standardize_image
+
+    with open(image_path, "rb") as f:
+        input_bytes = f.read()
+
+    baseline_rss = _peak_rss_bytes()
+    durations = []
+    output_size = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = standardize_image(input_bytes, {"profile": profile})
+        durations.append(time.perf_counter() - start)
+        output_size = len(output)
+
+    return {
+        "image": os.path.basename(image_path),
+        "profile": profile,
+        "input_bytes": len(input_bytes),
+        "output_bytes": output_size,
+        "median_seconds": statistics.median(durations),
+        "peak_memory_bytes": max(0, _peak_rss_bytes() - baseline_rss),
+    }
+
+
+def find_images(corpus_dir):
+    return sorted(
+        os.path.join(corpus_dir, name)
+        for name in os.listdir(corpus_dir)
+        if name.lower().endswith(SUPPORTED_EXTENSIONS)
+    )
+
+
+def main():
+    # Import here so --help works without the app's dependencies
+    from imaging import IMAGE_PROFILES
+
+    parser = argparse.ArgumentParser(description="Benchmark image standardization profiles.")
+    parser.add_argument("corpus", help="Directory of sample images")
+    parser.add_argument("--profiles", nargs="+", default=list(IMAGE_PROFILES) + ["auto"],
+                        help="Profiles to compare (default: all, plus auto)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per image and profile (default: 3)")
+    parser.add_argument("--csv", help="Also write the per-image results to this CSV file")
+    args = parser.parse_args()
+
+    images = find_images(args.corpus)
+    if not images:
+        parser.error(f"No supported images found in {args.corpus}")
+
+    # maxtasksperchild=1 gives every measurement a clean process, so peak
+    # memory from one image never hides the next one's
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    with context.Pool(processes=1, maxtasksperchild=1) as pool:
+        for image_path in images:
+            for profile in args.profiles:
+                row = pool.apply(_measure, (image_path, profile, args.repeat))
+                rows.append(row)
+                print(
+                    f"{row['image']:<32} {profile:<13} "
+                    f"{row['median_seconds'] * 1000:8.1f} ms "
+                    f"{row['input_bytes'] / 1024:9.0f} KB -> {row['output_bytes'] / 1024:7.0f} KB "
+                    f"peak +{row['peak_memory_bytes'] / (1024 * 1024):6.1f} MB"
+                )
+
+    print("\nSummary (mean per profile)")
+    for profile in args.profiles:
+        profile_rows = [row for row in rows if row["profile"] == profile]
+        print(
+            f"  {profile:<13} "
+            f"{statistics.mean(r['median_seconds'] for r in profile_rows) * 1000:8.1f} ms "
+            f"{statistics.mean(r['output_bytes'] for r in profile_rows) / 1024:7.0f} KB "
+            f"peak +{statistics.mean(r['peak_memory_bytes'] for r in profile_rows) / (1024 * 1024):6.1f} MB"
+        )
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"\nWrote {len(rows)} rows to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# === Fake Gemini Client for Offline Load Tests ===
+# A stand-in for google.genai.Client that streams canned Markdown with
+# configurable latency and error rates. Enable it with GENAI_BACKEND=fake.
+#
+# Settings (environment variables):
+#   FAKE_GENAI_FIRST_CHUNK_MS  Delay before the first chunk (default 800)
+#   FAKE_GENAI_CHUNK_MS        Delay between later chunks (default 50)
+#   FAKE_GENAI_CHUNKS          Chunks per extraction response (default 20)
+#   FAKE_GENAI_JITTER          Random +/- fraction applied to each delay (default 0.2)
+#   FAKE_GENAI_ERROR_RATE      Probability (0-1) that a call fails (default 0)
+import asyncio                    # For the async (client.aio) interface
+import json                       # To answer batch definition requests
+import os                         # For configuration from the environment
+import random                     # For jitter and injected errors
+import time                       # To simulate model latency
+
+CANNED_MARKDOWN_CHUNK = (
+    "## Section\n\n"
+    "The tenant is **liable** for any damage caused to the property. "
+    "Rent is due on the first day of each month and interest will accrue on late payments.\n\n"
+)
+FAKE_PROMPT_TOKENS = 1500
+CANNED_DEFINITION = (
+    "This word has a simple meaning. In this sentence, it tells you what the writer wants you to know."
+)
+
+
+class FakeGenAIError(Exception):
+    """Injected failure, raised at FAKE_GENAI_ERROR_RATE"""
+
+    code = 503  # Looks like a retryable "service unavailable" API error
+
+
+class FakeUsageMetadata:
+    def __init__(self, text):
+        # Rough token counts (about 4 characters per token) so usage accounting can be tested offline
+        self.prompt_token_count = FAKE_PROMPT_TOKENS
+        self.candidates_token_count = max(1, len(text) // 4)
+
+
+class FakeChunk:
+    def __init__(self, text, usage_text=None):
+        self.text = text
+        # Like the real API, the last chunk carries the token counts
+        self.usage_metadata = FakeUsageMetadata(usage_text) if usage_text is not None else None
+
+
+class FakeModels:
+    def __init__(self):
+        self.first_chunk_seconds = float(os.getenv("FAKE_GENAI_FIRST_CHUNK_MS", "800")) / 1000
+        self.chunk_seconds = float(os.getenv("FAKE_GENAI_CHUNK_MS", "50")) / 1000
+        self.chunks = int(os.getenv("FAKE_GENAI_CHUNKS", "20"))
+        self.jitter = float(os.getenv("FAKE_GENAI_JITTER", "0.2"))
+        self.error_rate = float(os.getenv("FAKE_GENAI_ERROR_RATE", "0"))
+
+    def _sleep(self, seconds):
+        time.sleep(max(0.0, seconds * random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    def _maybe_fail(self):
+        if random.random() < self.error_rate:
+            raise FakeGenAIError("Injected fake Gemini failure")
+
+    def generate_content_stream(self, model, contents, config=None):
+        """Yield canned chunks; definition models get one short answer"""
+        self._maybe_fail()
+        self._sleep(self.first_chunk_seconds)
+        if "lite" in model:
+            yield FakeChunk(CANNED_DEFINITION, usage_text=CANNED_DEFINITION)
+            return
+        for index in range(self.chunks):
+            if index:
+                self._sleep(self.chunk_seconds)
+            last = index == self.chunks - 1
+            yield FakeChunk(CANNED_MARKDOWN_CHUNK, usage_text=CANNED_MARKDOWN_CHUNK * self.chunks if last else None)
+
+    def generate_content(self, model, contents, config=None):
+        """Answer batch definition requests with one definition per item"""
+        self._maybe_fail()
+        self._sleep(self.first_chunk_seconds)
+        return self.generate_content_response(contents)
+
+    @staticmethod
+    def generate_content_response(contents):
+        try:
+            items = json.loads(contents[0].parts[0].text)
+        except (ValueError, AttributeError, IndexError, TypeError):
+            return FakeChunk(CANNED_DEFINITION, usage_text=CANNED_DEFINITION)
+        text = json.dumps([
+            {"index": item.get("index"), "definition": CANNED_DEFINITION}
+            for item in items if isinstance(item, dict)
+        ])
+        return FakeChunk(text, usage_text=text)
+
+
+class FakeAsyncModels(FakeModels):
+    """The client.aio.models interface, sleeping with asyncio instead of blocking"""
+
+    async def _async_sleep(self, seconds):
+        await asyncio.sleep(max(0.0, seconds * random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self._maybe_fail()
+        await self._async_sleep(self.first_chunk_seconds)
+        return self._stream(model)
+
+    async def _stream(self, model):
+        if "lite" in model:
+            yield FakeChunk(CANNED_DEFINITION, usage_text=CANNED_DEFINITION)
+            return
+        for index in range(self.chunks):
+            if index:
+                await self._async_sleep(self.chunk_seconds)
+            last = index == self.chunks - 1
+            yield FakeChunk(CANNED_MARKDOWN_CHUNK, usage_text=CANNED_MARKDOWN_CHUNK * self.chunks if last else None)
+
+    async def generate_content(self, model, contents, config=None):
+        self._maybe_fail()
+        await self._async_sleep(self.first_chunk_seconds)
+        return FakeModels.generate_content_response(contents)
+
+
+class FakeAsyncClient:
+    def __init__(self):
+        self.models = FakeAsyncModels()
+
+
+class FakeClient:
+    """Drop-in replacement for the parts of genai.Client that app.py uses"""
+
+    def __init__(self):
+        self.models = FakeModels()
+        self.aio = FakeAsyncClient()
@@ -0,0 +1,200 @@
+# === Image Standardization ===
+# Pillow work shared by the web app and its standardization worker processes.
+# It lives apart from app.py so a spawned worker imports only this module and
+# Pillow, not the Flask app, its stores and the Gemini client. Pillow itself
+# is imported on first use, so the app can read the settings here at startup.
+import io                         # For in-memory binary operations
+import logging                    # For standardization warnings
+import os                         # For the IMAGE_PROFILE setting
+import threading                  # Guards one-time HEIF registration
+
+logger = logging.getLogger(__name__)
+
+heif_support_registered = False
+heif_support_lock = threading.Lock()
+
+def ensure_heif_support():
+    """Register the HEIC/HEIF opener with Pillow the first time an image is opened"""
+    global heif_support_registered
+    if heif_support_registered:
+        return
+    with heif_support_lock:
+        if not heif_support_registered:
+            import pillow_heif           # HEIC/HEIF image format support
+            pillow_heif.register_heif_opener()
+            heif_support_registered = True
+
+# === Image Standardization Profiles ===
+# Each profile trades model upload size against CPU time. "auto" picks the
+# target size per image from its resolution and text density.
+IMAGE_PROFILES = {
+    "fast": {"max_dimension": 1600, "quality": 80, "sharpen": False, "optimize": False},
+    "balanced": {"max_dimension": 2048, "quality": 85, "sharpen": True, "optimize": True},
+    "max-fidelity": {"max_dimension": 3072, "quality": 92, "sharpen": True, "optimize": True},
+}
+IMAGE_PROFILE = os.getenv("IMAGE_PROFILE", "balanced")
+# A typo here would otherwise make every standardization fail and send
+# every upload to Gemini unstandardized, with only a warning per upload
+if IMAGE_PROFILE != "auto" and IMAGE_PROFILE not in IMAGE_PROFILES:
+    raise ValueError(f"Unknown IMAGE_PROFILE {IMAGE_PROFILE!r}; use one of {', '.join(IMAGE_PROFILES)} or auto")
+
+# Fraction of edge pixels in a small grayscale preview; dense small print needs
+# more pixels to stay legible, sparse large print reads fine when smaller.
+TEXT_DENSITY_LOW = 0.04
+TEXT_DENSITY_HIGH = 0.12
+
+def estimate_text_density(img):
+    """
+    Estimate how much of an image is covered by fine detail such as text.
+
+    Works on a 256px grayscale preview, so it costs a few milliseconds even
+    for large photos.
+
+    Returns:
+        The fraction (0-1) of preview pixels that lie on a strong edge.
+    """
+    from PIL import ImageFilter
+    preview = img.convert("L")
+    preview.thumbnail((256, 256))
+    edges = preview.filter(ImageFilter.FIND_EDGES)
+    histogram = edges.histogram()
+    strong_edges = sum(histogram[64:])
+    return strong_edges / max(1, preview.width * preview.height)
+
+def choose_auto_max_dimension(img):
+    """Pick a target size for the "auto" profile from text density and source resolution"""
+    density = estimate_text_density(img)
+    if density >= TEXT_DENSITY_HIGH:
+        max_dimension = IMAGE_PROFILES["max-fidelity"]["max_dimension"]
+    elif density <= TEXT_DENSITY_LOW:
+        max_dimension = IMAGE_PROFILES["fast"]["max_dimension"]
+    else:
+        max_dimension = IMAGE_PROFILES["balanced"]["max_dimension"]
+    # Never ask for more pixels than the source has
+    return min(max_dimension, max(img.size))
+
+# === Helper Function: Standardize Image ===
+def standardize_image(input_image, options: dict = None) -> bytes:
+    """
+    Standardizes an image by resizing, sharpening, and compressing to JPEG.
+    Ideal for processing user-uploaded photos to ensure consistency and performance.
+
+    Args:
+        input_image: The raw bytes of the input image (HEIC, JPEG, etc.), or a
+            path or binary file object to decode from without reading it all first.
+        options: A dictionary for optional settings. Values override the profile.
+            - profile (str): "fast", "balanced", "max-fidelity" or "auto".
+              Defaults to the IMAGE_PROFILE environment variable ("balanced").
+            - max_dimension (int): The maximum width or height. Defaults to 2048.
+            - quality (int): The output JPEG quality (1-95). Defaults to 85.
+            - sharpen (bool): Apply a sharpening filter. Defaults to True.
+            - optimize (bool): Extra encoder pass for smaller files. Defaults to True.
+
+    Returns:
+        The raw bytes of the processed JPEG image.
+        
+    Raises:
+        IOError: If the image format is not supported or the data is corrupt.
+        ValueError: If the profile name is unknown.
+    """
+    from PIL import Image, ImageFilter  # Pillow for image processing
+
+    if options is None:
+        options = {}
+
+    profile_name = options.get('profile', IMAGE_PROFILE)
+    auto_size = profile_name == "auto"
+    if auto_size:
+        profile = IMAGE_PROFILES["balanced"]
+    elif profile_name in IMAGE_PROFILES:
+        profile = IMAGE_PROFILES[profile_name]
+    else:
+        raise ValueError(f"Unknown image profile: {profile_name}")
+
+    settings = {
+        'max_dimension': options.get('max_dimension', profile['max_dimension']),
+        'quality': options.get('quality', profile['quality']),
+        'sharpen': options.get('sharpen', profile['sharpen']),
+        'optimize': options.get('optimize', profile['optimize'])
+    }
+    # An explicit max_dimension wins over the content-aware choice
+    auto_size = auto_size and 'max_dimension' not in options
+
+    if isinstance(input_image, (bytes, bytearray)):
+        input_image = io.BytesIO(input_image)
+
+    try:
+        # Open the image lazily; pixels are not decoded until needed
+        ensure_heif_support()
+        with Image.open(input_image) as img:
+            # The largest size any profile could pick bounds the decode
+            decode_limit = IMAGE_PROFILES["max-fidelity"]["max_dimension"] if auto_size else settings['max_dimension']
+
+            # For JPEGs, ask the decoder to scale down by 1/2, 1/4 or 1/8 while
+            # decoding, so a 12MP photo never expands to full size in memory.
+            # This is a no-op for other formats.
+            img.draft("RGB", (decode_limit, decode_limit))
+
+            if auto_size:
+                settings['max_dimension'] = choose_auto_max_dimension(img)
+            target_size = (settings['max_dimension'], settings['max_dimension'])
+
+            # Resize the image while maintaining aspect ratio. Done before any
+            # mode conversion so the conversion works on the smaller image.
+            img.thumbnail(target_size)
+
+            # If image has transparency (like some PNGs or HEICs), convert it to RGB
+            # as JPEG does not support an alpha channel.
+            if img.mode in ("RGBA", "P", "LA"):
+                img = img.convert("RGB")
+
+            # Sharpen the image to enhance text clarity
+            if settings['sharpen']:
+                img = img.filter(ImageFilter.SHARPEN)
+
+            # Save the processed image to an in-memory buffer
+            output_buffer = io.BytesIO()
+            img.save(
+                output_buffer,
+                format="JPEG",
+                quality=settings['quality'],
+                optimize=settings['optimize']  # Extra pass to find best compression
+            )
+            return output_buffer.getvalue()
+
+    except Exception as e:
+        print(f"Error during image standardization: {e}")
+        # Re-raising the exception allows the calling function to handle the error
+        raise
+
+def mime_type_for_extension(file_extension):
+    """MIME type Gemini should be told for an unstandardized upload"""
+    if file_extension in ['.pdf']:
+        return "application/pdf"
+    elif file_extension in ['.png']:
+        return "image/png"
+    elif file_extension in ['.jpg', '.jpeg']:
+        return "image/jpeg"
+    elif file_extension in ['.heic', '.heif']:
+        return "image/heic"
+    elif file_extension in ['.webp']:
+        return "image/webp"
+    # Default to JPEG for unsupported formats
+    return "image/jpeg"
+
+# === Multi-File Documents: Pool Worker ===
+def prepare_document_part(source, file_extension):
+    """
+    Turn one uploaded file into (bytes, mime_type) for Gemini. Runs in a pool
+    process. Images are standardized, falling back to the original bytes like
+    process_file() does; PDFs pass through unchanged.
+    """
+    if file_extension != ".pdf":
+        try:
+            return standardize_image(source), "image/jpeg"  # Standardized images are always JPEG
+        except Exception as e:
+            logger.warning(f"Image standardization failed, using original: {e}")
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source), mime_type_for_extension(file_extension)
+    with open(source, "rb") as file:
+        return file.read(), mime_type_for_extension(file_extension)
@@ -0,0 +1,213 @@
+# === Offline Load Test ===
+# Drives /upload, /status/<job_id> and /get-definition concurrently and
+# reports latency percentiles, throughput and memory.
+#
+# By default the app is started in this process against the fake Gemini
+# backend (GENAI_BACKEND=fake), so no credentials or model quota are used.
+# Pass --url to load-test a server that is already running instead.
+#
+# Usage:
+#   python loadtest.py --users 20 --duration 60
+#   FAKE_GENAI_FIRST_CHUNK_MS=2000 FAKE_GENAI_ERROR_RATE=0.05 python loadtest.py --users 50
+#   python loadtest.py --url http://localhost:5000 --users 10
+import argparse                   # For command line options
+import io                         # For in-memory sample images
+import json                       # To encode and decode API bodies
+import math                       # For nearest-rank percentiles
+import os                         # For environment configuration
+import random                     # To vary uploads and words
+import statistics                 # For throughput math
+import sys                        # For platform checks
+import threading                  # For concurrent simulated users
+import time                       # For timing operations
+import urllib.error               # For HTTP error handling
+import urllib.request             # Dependency-free HTTP client
+import uuid                       # For multipart boundaries
+
+SAMPLE_WORDS = ["tenant", "liable", "property", "accrue", "interest", "payment", "the", "with"]
+SAMPLE_CONTEXT = (
+    "The tenant is liable for any damage caused to the property. "
+    "Rent is due on the first day of each month and interest will accrue on late payments."
+)
+
+
+# === Metrics Collection ===
+class Recorder:
+    """Collects per-operation latencies and error counts from all user threads"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation, seconds, ok=True):
+        with self.lock:
+            self.latencies.setdefault(operation, []).append(seconds)
+            if not ok:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process (includes the in-process server)"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# === HTTP Helpers ===
+def http_request(url, data=None, headers=None, method=None):
+    """Return (status, parsed JSON body) without raising on HTTP errors"""
+    request = urllib.request.Request(url, data=data, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            return response.status, json.loads(response.read() or b"{}")
+    except urllib.error.HTTPError as e:
+        try:
+            body = json.loads(e.read() or b"{}")
+        except ValueError:
+            body = {}
+        return e.code, body
+
+
+def make_sample_image(unique):
+    """A small JPEG; unique images defeat the result cache, shared ones hit it"""
+    from PIL import Image
+    color = tuple(random.randrange(256) for _ in range(3)) if unique else (240, 240, 240)
+    buffer = io.BytesIO()
+    Image.new("RGB", (1200, 1600), color).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def encode_multipart(field, filename, content, content_type):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8") + content + f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+# === Simulated User ===
+def run_user(base_url, args, recorder, stop_at, sample_file):
+    while time.time() < stop_at:
+        # Upload a document and wait for the job to finish
+        if sample_file:
+            content, filename = sample_file
+        else:
+            content, filename = make_sample_image(unique=not args.same_file), "page.jpg"
+        body, content_type = encode_multipart("file", filename, content, "application/octet-stream")
+
+        job_start = time.time()
+        start = time.time()
+        status, data = http_request(f"{base_url}/upload", data=body, headers={"Content-Type": content_type})
+        recorder.record("upload", time.time() - start, ok=status in (200, 202))
+
+        job_id = data.get("job_id") if status in (200, 202) else None
+        while job_id and time.time() < stop_at + args.drain_seconds:
+            start = time.time()
+            status, data = http_request(f"{base_url}/status/{job_id}")
+            recorder.record("status", time.time() - start, ok=status == 200)
+            if status != 200 or data.get("status") == "failed":
+                recorder.record("job", time.time() - job_start, ok=False)
+                break
+            if data.get("status") == "completed":
+                recorder.record("job", time.time() - job_start)
+                break
+            time.sleep(args.poll_interval)
+
+        # Look up a few words, as a reader would
+        for _ in range(args.definitions):
+            payload = json.dumps({
+                "word to define": random.choice(SAMPLE_WORDS),
+                "context sentence": SAMPLE_CONTEXT,
+            }).encode("utf-8")
+            start = time.time()
+            status, _ = http_request(
+                f"{base_url}/get-definition", data=payload, headers={"Content-Type": "application/json"}
+            )
+            recorder.record("get-definition", time.time() - start, ok=status == 200)
+
+
+def start_local_server(port):
+    """Import the app against the fake backend and serve it from a thread"""
+    os.environ.setdefault("GENAI_BACKEND", "fake")
+    # Every simulated user shares one IP, so per-client limits would throttle the test itself
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    from werkzeug.serving import make_server
+    import app as app_module
+
+    server = make_server("127.0.0.1", port, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{port}"
+
+
+def print_report(recorder, elapsed, in_process):
+    print(f"\n{'operation':<16} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8}")
+    for operation in ("upload", "status", "get-definition", "job"):
+        values = recorder.latencies.get(operation)
+        if not values:
+            continue
+        print(
+            f"{operation:<16} {len(values):>7} {recorder.errors.get(operation, 0):>7} "
+            f"{percentile(values, 0.50) * 1000:>9.1f} {percentile(values, 0.95) * 1000:>9.1f} "
+            f"{percentile(values, 0.99) * 1000:>9.1f} {len(values) / elapsed:>8.2f}"
+        )
+    all_values = [v for values in recorder.latencies.values() for v in values]
+    if all_values:
+        print(f"\nMean request latency: {statistics.mean(all_values) * 1000:.1f} ms over {elapsed:.1f} s")
+    if in_process:
+        print(f"Peak memory (client + server): {peak_rss_mb():.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the Engaging Reader API.")
+    parser.add_argument("--url", help="Base URL of a running server (default: start one with the fake backend)")
+    parser.add_argument("--port", type=int, default=5055, help="Port for the in-process server (default: 5055)")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent simulated users (default: 10)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to start new work (default: 30)")
+    parser.add_argument("--drain-seconds", type=float, default=120,
+                        help="Extra seconds to wait for in-flight jobs (default: 120)")
+    parser.add_argument("--definitions", type=int, default=3, help="Definition lookups per document (default: 3)")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between status polls (default: 1)")
+    parser.add_argument("--file", help="Upload this file instead of generated images")
+    parser.add_argument("--same-file", action="store_true", help="Upload identical images (exercises caching)")
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.url.rstrip("/") if args.url else None
+    if not base_url:
+        server, base_url = start_local_server(args.port)
+
+    sample_file = None
+    if args.file:
+        with open(args.file, "rb") as f:
+            sample_file = (f.read(), os.path.basename(args.file))
+
+    recorder = Recorder()
+    start = time.time()
+    stop_at = start + args.duration
+    users = [
+        threading.Thread(target=run_user, args=(base_url, args, recorder, stop_at, sample_file))
+        for _ in range(args.users)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.time() - start
+
+    print_report(recorder, elapsed, in_process=server is not None)
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
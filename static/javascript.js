@@ -8,6 +8,8 @@ const dropArea = document.getElementById("drop-area");
 let speechSynthesis = window.speechSynthesis || window.webkitSpeechSynthesis;
 let mainSpeechUtterance = null;
 let currentText = "";
+let readingView = null; // Server-built words, blocks and sentences for the current document (optional)
+let sentenceOfWord = []; // Index into readingView.sentences for each word
 let mainWords = [];
 let mainCurrentWordIndex = 0;
 let mainWordSpans = [];
@@ -424,25 +426,34 @@ async function uploadImage() {
         return;
     }
 
-    const file = fileInput.files[0];
+    // Several files (e.g. each page of a letter) are read as one document, in selection order
+    const files = Array.from(fileInput.files);
+    const maxFiles = 20;
+    if (files.length > maxFiles) {
+        showError(`Please select at most ${maxFiles} files at once.`);
+        announceError(`Too many files. Please select at most ${maxFiles} files.`);
+        return;
+    }
 
     // Validate file type - support images and PDFs
     const allowedTypes = ['image/jpeg', 'image/jpg', 'image/png', 'image/heic', 'image/heif', 'image/webp', 'application/pdf'];
     const allowedExtensions = ['.jpg', '.jpeg', '.png', '.heic', '.heif', '.webp', '.pdf'];
     
-    // Check both MIME type and file extension (HEIC files might not have proper MIME type on all browsers)
-    const fileName = file.name.toLowerCase();
-    const hasValidExtension = allowedExtensions.some(ext => fileName.endsWith(ext));
-    
-    if (!allowedTypes.includes(file.type) && !hasValidExtension) {
-        showError("Please select a valid file (JPEG, PNG, HEIC, WebP, or PDF).");
-        announceError("Invalid file type. Please select an image or PDF file.");
-        return;
+    for (const file of files) {
+        // Check both MIME type and file extension (HEIC files might not have proper MIME type on all browsers)
+        const fileName = file.name.toLowerCase();
+        const hasValidExtension = allowedExtensions.some(ext => fileName.endsWith(ext));
+        
+        if (!allowedTypes.includes(file.type) && !hasValidExtension) {
+            showError("Please select a valid file (JPEG, PNG, HEIC, WebP, or PDF).");
+            announceError("Invalid file type. Please select an image or PDF file.");
+            return;
+        }
     }
 
     // Check file size (50MB limit - generous for high-quality documents)
     const maxSize = 50 * 1024 * 1024; // 50MB in bytes
-    if (file.size > maxSize) {
+    if (files.reduce((total, file) => total + file.size, 0) > maxSize) {
         showError("File size exceeds 50MB limit. Please choose a smaller file.");
         announceError("File too large. Please choose a file under 50MB.");
         return;
@@ -455,9 +466,9 @@ async function uploadImage() {
 
     try {
         const formData = new FormData();
-        formData.append("file", file);
+        files.forEach(file => formData.append("file", file));
 
-        const response = await fetch("/upload", {
+        const response = await fetch("/upload?view=reading", {
             method: "POST",
             body: formData
         });
@@ -478,9 +489,59 @@ async function uploadImage() {
         const maxPollAttempts = 300; // 5 minutes max (300 * 1 second)
         const pollInterval = 1000; // Poll every 1 second
 
+        // Render the finished document and enable reading controls
+        const showCompletedResult = (result) => {
+            let cleanHtml;
+            readingView = expandReadingView(result.reading_view);
+            if (readingView) {
+                // The server already rendered the document and wrapped its words
+                // in bare spans; give them the word classes and attributes here
+                cleanHtml = DOMPurify.sanitize(readingView.html);
+                outputDiv.innerHTML = cleanHtml;
+                outputDiv.querySelectorAll('span.w').forEach(span => {
+                    span.className = 'word highlight-word';
+                    span.setAttribute('tabindex', '-1');
+                    span.setAttribute('role', 'button');
+                });
+            } else {
+                const dirtyHtml = marked.parse(result.markdown || "");
+                cleanHtml = DOMPurify.sanitize(dirtyHtml);
+                outputDiv.innerHTML = cleanHtml;
+                wrapWordsInSpans(outputDiv);
+            }
+            initializeWordNavigation();
+            
+            // Enable play button and store the current text
+            currentText = cleanHtml;
+            
+            // Set initial button states (not playing)
+            updateButtonStates(false);
+
+            // Show speech controls after successful processing
+            document.getElementById('speech-controls').style.display = 'flex';
+
+            // Hide upload container and show content
+            document.getElementById('upload-container').style.display = 'none';
+            
+            loadingOverlay.style.display = 'none';
+            announceStatus("Text extracted successfully. Use spacebar to start reading or tab to navigate words.");
+
+            // Fetch likely lookups now so double-clicks answer instantly
+            prefetchDefinitions();
+        };
+
+        const showProcessingError = (error) => {
+            console.error("Error processing file:", error);
+            loadingOverlay.style.display = 'none';
+            showError(error.message);
+            announceError("Failed to process file. Please try again.");
+            // Keep speech controls hidden on error
+            document.getElementById('speech-controls').style.display = 'none';
+        };
+
         const pollForResults = async () => {
             try {
-                const statusResponse = await fetch(`/status/${jobId}`);
+                const statusResponse = await fetch(`/status/${jobId}?view=reading`);
                 const statusData = await statusResponse.json();
                 
                 if (!statusResponse.ok) {
@@ -489,30 +550,16 @@ async function uploadImage() {
                 
                 if (statusData.status === "completed") {
                     // Processing complete, render the markdown
-                    const dirtyHtml = marked.parse(statusData.result.markdown || "");
-                    const cleanHtml = DOMPurify.sanitize(dirtyHtml);
-                    
-                    outputDiv.innerHTML = cleanHtml;
-                    wrapWordsInSpans(outputDiv);
-                    initializeWordNavigation();
-                    
-                    // Enable play button and store the current text
-                    currentText = cleanHtml;
-                    
-                    // Set initial button states (not playing)
-                    updateButtonStates(false);
-
-                    // Show speech controls after successful processing
-                    document.getElementById('speech-controls').style.display = 'flex';
-
-                    // Hide upload container and show content
-                    document.getElementById('upload-container').style.display = 'none';
-                    
-                    loadingOverlay.style.display = 'none';
-                    announceStatus("Text extracted successfully. Use spacebar to start reading or tab to navigate words.");
+                    showCompletedResult(statusData.result);
                 } else if (statusData.status === "failed") {
                     throw new Error(statusData.error || "Processing failed");
                 } else if (statusData.status === "processing") {
+                    // Let the user know when the job is waiting behind others
+                    if (statusData.queue_position) {
+                        announceStatus(`Waiting in line (position ${statusData.queue_position})...`);
+                    } else if (statusData.progress) {
+                        announceStatus(`Extracted ${statusData.progress.completed_parts} of ${statusData.progress.total_parts} parts...`);
+                    }
                     // Still processing, poll again
                     pollAttempts++;
                     if (pollAttempts >= maxPollAttempts) {
@@ -525,17 +572,59 @@ async function uploadImage() {
                     throw new Error("Unexpected processing status. Please try again.");
                 }
             } catch (error) {
-                console.error("Error polling for results:", error);
-                loadingOverlay.style.display = 'none';
-                showError(error.message);
-                announceError("Failed to process file. Please try again.");
-                // Keep speech controls hidden on error
-                document.getElementById('speech-controls').style.display = 'none';
+                showProcessingError(error);
             }
         };
 
-        // Start polling
-        pollForResults();
+        // Stream Markdown as Gemini produces it so reading can start early.
+        // Falls back to polling if Server-Sent Events are unavailable.
+        const streamResults = () => {
+            const source = new EventSource(`/stream/${jobId}?view=reading`);
+            let streamedMarkdown = "";
+
+            source.addEventListener("queued", (event) => {
+                const { queue_position } = JSON.parse(event.data);
+                if (queue_position) {
+                    announceStatus(`Waiting in line (position ${queue_position})...`);
+                }
+            });
+
+            source.addEventListener("progress", (event) => {
+                const { completed_parts, total_parts } = JSON.parse(event.data);
+                announceStatus(`Extracted ${completed_parts} of ${total_parts} parts...`);
+            });
+
+            source.addEventListener("chunk", (event) => {
+                streamedMarkdown += JSON.parse(event.data).text;
+                // Show partial text right away; words become interactive once complete
+                outputDiv.innerHTML = DOMPurify.sanitize(marked.parse(streamedMarkdown));
+                loadingOverlay.style.display = 'none';
+            });
+
+            source.addEventListener("done", (event) => {
+                source.close();
+                showCompletedResult(JSON.parse(event.data).result);
+            });
+
+            source.addEventListener("error", (event) => {
+                source.close();
+                if (event.data) {
+                    showProcessingError(new Error(JSON.parse(event.data).error || "Processing failed"));
+                } else {
+                    // Connection-level failure: the job keeps running, so poll for the result
+                    pollForResults();
+                }
+            });
+        };
+
+        if (data.status === "completed" && data.result) {
+            // Cached result, nothing to wait for
+            showCompletedResult(data.result);
+        } else if (window.EventSource) {
+            streamResults();
+        } else {
+            pollForResults();
+        }
 
     } catch (error) {
         showError(error.message);
@@ -659,9 +748,14 @@ function readText() {
     isManuallyPaused = false;
 
     // 1. Get the plain text for the speech synthesis engine BEFORE modifying the DOM
-    const tempDiv = document.createElement('div');
-    tempDiv.innerHTML = currentText;
-    const cleanText = tempDiv.textContent;
+    let cleanText;
+    if (readingView) {
+        cleanText = readingView.text;
+    } else {
+        const tempDiv = document.createElement('div');
+        tempDiv.innerHTML = currentText;
+        cleanText = tempDiv.textContent;
+    }
 
     // 2. Get all word spans for highlighting (words are already wrapped)
     mainWordSpans = Array.from(document.querySelectorAll('.highlight-word'));
@@ -702,6 +796,13 @@ function readText() {
             const charIndex = event.charIndex;
             let currentCharCount = 0;
 
+            if (readingView) {
+                // Precomputed word offsets: binary search instead of a scan
+                mainCurrentWordIndex = wordIndexAtOffset(charIndex);
+                highlightCurrentWord(mainCurrentWordIndex);
+                return;
+            }
+
             // Find which word we're at based on character index
             for (let i = 0; i < mainWords.length; i++) {
                 currentCharCount += mainWords[i].length + (i === mainWords.length - 1 ? 0 : 1); // +1 for space except last word
@@ -1076,20 +1177,7 @@ function handleWordSelection(event) {
 
     // Only proceed if we have a single word
     if (selectedText && selectedText.split(' ').length === 1) {
-        // Find the closest meaningful container for context
-        while (contextElement && 
-               contextElement !== outputDiv && 
-               !['P', 'DIV', 'SECTION', 'ARTICLE', 'H1', 'H2', 'H3', 'H4', 'H5', 'H6'].includes(contextElement.tagName)) {
-            contextElement = contextElement.parentElement;
-        }
-        
-        // Get context from the meaningful container, fallback to full text
-        let context = contextElement ? 
-            (contextElement.textContent || contextElement.innerText) : 
-            (outputDiv.textContent || outputDiv.innerText);
-
-        // Limit context to a reasonable length
-        context = context.substring(0, 500);
+        const context = getWordContext(contextElement);
 
         // Pause main reading when user clicks a word (automatic pause, not manual)
         if (isMainSpeaking) {
@@ -1116,6 +1204,85 @@ function handleWordSelection(event) {
     }
 }
 
+// Rebuild the word offsets and the block and sentence ranges that the server
+// leaves out of the reading view: words in its text are separated by one
+// space, and blocks by a newline
+function expandReadingView(view) {
+    if (!view || view.offsets) {
+        return view || null; // Missing, or a version 1 view that carries them
+    }
+    const text = view.text;
+    const offsets = [];
+    const blocks = [];
+    let blockStart = 0;
+    let atWordStart = true;
+    for (let i = 0; i < text.length; i++) {
+        const ch = text[i];
+        if (ch === ' ' || ch === '\n') {
+            atWordStart = true;
+            if (ch === '\n') {
+                blocks.push([blockStart, offsets.length - 1]);
+                blockStart = offsets.length;
+            }
+        } else if (atWordStart) {
+            offsets.push(i);
+            atWordStart = false;
+        }
+    }
+    if (offsets.length) {
+        blocks.push([blockStart, offsets.length - 1]);
+    }
+    const starts = view.sentence_starts;
+    const sentences = starts.map((start, i) => [start, (i + 1 < starts.length ? starts[i + 1] : offsets.length) - 1]);
+    return Object.assign({}, view, { offsets, blocks, sentences });
+}
+
+// Index of the word starting at or before a character of readingView.text
+function wordIndexAtOffset(charIndex) {
+    const offsets = readingView.offsets;
+    let low = 0;
+    let high = offsets.length - 1;
+    while (low < high) {
+        const mid = (low + high + 1) >> 1;
+        if (offsets[mid] <= charIndex) {
+            low = mid;
+        } else {
+            high = mid - 1;
+        }
+    }
+    return low;
+}
+
+// Get the context sentence sent with a word: its sentence from the reading
+// view when available, otherwise the text of its closest block container
+function getWordContext(contextElement, wordIndex = -1) {
+    if (readingView && contextElement && contextElement.classList &&
+        contextElement.classList.contains('highlight-word')) {
+        if (wordIndex < 0) {
+            wordIndex = mainWordSpans.indexOf(contextElement);
+        }
+        if (wordIndex >= 0) {
+            const [start, end] = readingView.sentences[sentenceOfWord[wordIndex]];
+            return mainWords.slice(start, end + 1).join(' ').substring(0, 500);
+        }
+    }
+
+    // Find the closest meaningful container for context
+    while (contextElement && 
+           contextElement !== outputDiv && 
+           !['P', 'DIV', 'SECTION', 'ARTICLE', 'H1', 'H2', 'H3', 'H4', 'H5', 'H6'].includes(contextElement.tagName)) {
+        contextElement = contextElement.parentElement;
+    }
+    
+    // Get context from the meaningful container, fallback to full text
+    const context = contextElement ? 
+        (contextElement.textContent || contextElement.innerText) : 
+        (outputDiv.textContent || outputDiv.innerText);
+
+    // Limit context to a reasonable length
+    return context.substring(0, 500);
+}
+
 // Show definition modal
 function showDefinitionModal(word, content) {
     definitionWord.textContent = word;
@@ -1158,8 +1325,60 @@ function closeDefinitionModal() {
     }
 }
 
+// Definitions prefetched for the current document: {normalized word: {context: definition}}
+let definitionCache = {};
+
+// Match the server's word normalization (lowercase, no surrounding punctuation)
+function normalizeWord(word) {
+    return word.trim().replace(/^[.,;:!?"'()\[\]{}“”‘’]+|[.,;:!?"'()\[\]{}“”‘’]+$/g, '').toLowerCase();
+}
+
+// Warm the definition cache with the document's longer, harder words in the background
+async function prefetchDefinitions() {
+    definitionCache = {};
+    const minWordLength = 8;
+    const maxItems = 60;
+    const seen = new Set();
+    const items = [];
+
+    for (let i = 0; i < mainWordSpans.length; i++) {
+        const span = mainWordSpans[i];
+        const word = normalizeWord(span.textContent);
+        if (word.length < minWordLength || !/^[a-z-]+$/.test(word)) continue;
+        const context = getWordContext(span, i);
+        const key = `${word}\n${context}`;
+        if (seen.has(key)) continue;
+        seen.add(key);
+        items.push({ "word to define": word, "context sentence": context });
+        if (items.length >= maxItems) break;
+    }
+
+    if (!items.length) return;
+
+    try {
+        const response = await fetch('/get-definitions', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ items })
+        });
+        if (!response.ok) return;
+        const data = await response.json();
+        Object.assign(definitionCache, data.definitions || {});
+    } catch (error) {
+        // Prefetching is best effort; clicks still fetch definitions on demand
+        console.warn('Definition prefetch failed:', error);
+    }
+}
+
 // Get definition from Google AI
 async function getDefinition(word, context) {
+    const cached = definitionCache[normalizeWord(word)];
+    if (cached && cached[context]) {
+        return cached[context];
+    }
+
     try {
         const response = await fetch('/get-definition', {
             method: 'POST',
@@ -1559,6 +1778,23 @@ function initializeWordNavigation() {
     mainWordSpans = Array.from(document.querySelectorAll('.highlight-word'));
     mainWords = mainWordSpans.map(span => span.textContent);
     
+    if (readingView && readingView.blocks.length && mainWords.length === readingView.offsets.length) {
+        // Use the server's block and sentence boundaries instead of walking the DOM
+        paragraphBoundaries = readingView.blocks.map(([startIndex, endIndex]) => ({
+            element: mainWordSpans[startIndex].parentElement,
+            startIndex: startIndex,
+            endIndex: endIndex
+        }));
+        sentenceOfWord = new Array(mainWords.length);
+        readingView.sentences.forEach(([start, end], sentenceIndex) => {
+            sentenceOfWord.fill(sentenceIndex, start, end + 1);
+        });
+        return;
+    }
+
+    // The page does not match the reading view (or there is none): fall back to the DOM
+    readingView = null;
+
     // Detect paragraph boundaries using HTML structure
     detectParagraphBoundaries();
 }